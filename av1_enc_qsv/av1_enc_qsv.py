@@ -1,40 +1,74 @@
 #!/usr/bin/env python3
 
 import curses
+import errno
+import fcntl
 import os
 import shutil
 import subprocess
 import threading
 import time
-import json
-from collections import deque
+import multiprocessing
+import queue
+import select
+import sqlite3
+from collections import Counter, deque
+from concurrent.futures import ThreadPoolExecutor
 from dataclasses import dataclass, field
-import math
+from functools import lru_cache
+from itertools import islice
+import mmap
 import sys 
 import argparse 
 
+try:
+    import av # Optional: PyAV lets us read the codec in-process instead of spawning ffprobe
+except ImportError:
+    av = None
+
 # --- Configuration ---
 SOURCE_DIRECTORY = "."  
 TEMP_DIRECTORY = "/ssd/av1_tmp/" 
 NUM_FILES_TO_PREPARE = 2  
-NUM_FFMPEG_WORKERS = 1 
+NUM_FFMPEG_WORKERS = 2 # Concurrent av1_qsv sessions; one QSV device handles several before the media engine saturates
 QSV_DEVICE = "/dev/dri/renderD128"  
 FFMPEG_PATH = "ffmpeg"
 FFPROBE_PATH = "ffprobe"
 LOG_MAX_LINES = 300 
 VIDEO_EXTENSIONS = ('.mp4', '.mkv', '.avi', '.mov', '.webm', '.flv', '.ts', '.mts', '.m2ts') 
+VIDEO_EXT_SET = frozenset(ext.lstrip('.') for ext in VIDEO_EXTENSIONS)
 FFMPEG_ENCODE_TIMEOUT_SECONDS = 10 * 60 
+FFMPEG_STDERR_TAIL_LINES = 200 # Last lines of FFmpeg's stderr kept for the error details
+FFMPEG_THREADS = 0 # -threads for FFmpeg's CPU side (demux/mux/audio copy); 0 splits the usable CPUs between the QSV sessions
+CPU_DECODE_THREADS = 4 # Decoder threads for inputs without a QSV decoder, unless --ffmpeg-threads is set
+CODEC_CACHE_FILENAME = ".codec_cache.db" # Stored in TEMP_DIRECTORY, keyed by (size, mtime, path)
+PROBE_BATCH_SIZE = 64 # Files probed ahead of the preparer per batch
+PROBE_WORKERS = min(8, os.cpu_count() or 1) 
+FFPROBE_QUICK_ARGS = ('-probesize', '65536', '-analyzeduration', '0') # Codec from the container header alone; retried without these if that finds nothing
+CODEC_PROBE_FAILED = "" # input_codec once a probe has failed, so the preparer does not repeat it; None means not probed yet
+PROBE_HELPER_TIMEOUT_SECONDS = 30 # A PyAV probe helper that takes longer is killed and ffprobe is used instead
 
 FFMPEG_BASE_ARGS = ['-y', '-hide_banner', '-loglevel', 'error']
-AV1_QSV_ENCODE_ARGS = ['-c:v', 'av1_qsv', '-preset', 'medium', '-look_ahead', '1'] 
+AV1_QSV_ENCODE_ARGS = ['-c:v', 'av1_qsv', '-async_depth', '4'] # -preset and look-ahead are appended per run from ARGS
+QSV_PRESET = "medium" # Overridden by --qsv-preset
+QSV_PRESETS = ('veryfast', 'faster', 'fast', 'medium', 'slow', 'slower', 'veryslow')
+LOOKAHEAD_DEPTH = 40 # Frames of look-ahead when --lookahead is given; off by default since it costs encode FPS
 AUDIO_COPY_ARGS = ['-c:a', 'copy']
 BOTTOM_STATUS_LINES = 4 
 SPINNER_CHARS = ['|', '/', '-', '\\']
+UI_TICK_SECONDS = 0.5 # With nothing else changing, only the spinner and timeout countdown are redrawn, this often
+UI_MIN_FRAME_SECONDS = 0.05 # Worker updates arriving closer together than this are drawn as one frame
+BESIDE_SOURCE_TAG = ".av1_enc_part" # Marks --output-beside-source outputs, which the scanner must not pick up as videos
+FICLONE = 0x40049409 # ioctl from linux/fs.h: share extents with the source (btrfs/XFS reflink)
+DIRECT_IO_CHUNK_SIZE = 1024 * 1024 # Staging copy chunk; must stay a multiple of 4096 for O_DIRECT
+shutil.COPY_BUFSIZE = 4 * 1024 * 1024 # Larger chunks for the userspace copy fallback (default is 64 KiB)
 
 ARGS = None 
+FFMPEG_SESSION_THREADS = 1 # Set from --ffmpeg-threads, --pin-cpus or the CPU count once arguments are parsed
+FFMPEG_COMMAND_PREFIX = FFMPEG_CPU_DECODE_ARGS = FFMPEG_OUTPUT_ARGS = () # Built once from ARGS by build_ffmpeg_templates()
 
 # --- File Item Dataclass ---
-@dataclass
+@dataclass(slots=True, eq=False) # No per-item __dict__; identity eq/hash so items can live in sets
 class FileItem:
     id: int
     original_path: str
@@ -48,15 +82,20 @@ class FileItem:
     encoded_size: int = None
     error_details: str = None
     input_codec: str = None 
+    probe_done: threading.Event = None # Set by the scanner while its pre-probe has claimed this item; the preparer waits on it instead of probing again
     qsv_input_codec: str = None 
     use_cpu_decode: bool = False 
-    encoding_start_time: float = None # Added to track when FFmpeg encoding starts
+    encoding_start_time: float = None # time.monotonic() when FFmpeg encoding started
+    _display_cache: tuple = field(default=None, init=False, repr=False) # (inputs, get_display_strings() result)
 
     def __post_init__(self):
         self.filename = os.path.basename(self.original_path)
         _ , self.extension = os.path.splitext(self.filename)
 
     def get_display_strings(self):
+        display_inputs = (self.status, self.status_message, self.original_size, self.encoded_size)
+        if self._display_cache is not None and self._display_cache[0] == display_inputs:
+            return self._display_cache[1]
         base_filename = self.filename
         size_details_str = ""
         
@@ -77,201 +116,504 @@ class FileItem:
         elif self.original_size > 0: 
              size_details_str = f"({format_size(self.original_size)})"
         
+        self._display_cache = (display_inputs, (base_filename, size_details_str, status_text_str))
         return base_filename, size_details_str, status_text_str
 
 
 # --- Global State ---
 all_files = []
-pending_files_queue = deque()
-preparing_files_list = [] 
-ready_for_encode_queue = deque() 
-encoding_files_list = [] 
+pending_files_queue = queue.SimpleQueue() # Unbounded handoff to the preparer; never touched under ui_lock
+preparing_files = set() 
+ready_for_encode_queue = queue.Queue(maxsize=NUM_FILES_TO_PREPARE) # put() blocks the preparer once this many files are waiting
+encoding_files = set() # Unordered; the UI takes the lowest id as the current encode
+finalize_queue = queue.SimpleQueue() # Encoded files waiting to be moved back, so encoders can start the next file straight away
 
 log_messages = deque(maxlen=LOG_MAX_LINES)
 stop_event = threading.Event()
 ui_needs_update = threading.Event()
+ui_wake_r, ui_wake_w = os.pipe() # wake_ui() writes a byte here so the UI's select() returns as soon as there is something to draw
+os.set_blocking(ui_wake_r, False); os.set_blocking(ui_wake_w, False)
 ui_lock = threading.Lock() 
-spinner_index = 0 
+status_counts = Counter() # Items in all_files per status; maintained by set_status so the UI never has to count
+encode_wakeup = threading.Condition(ui_lock) # Notified on user cancel, app stop and FFmpeg exit
+ticker_cells = {} # Where draw_ui last put the spinner and the timeout countdown, for draw_ticker
+lines_on_screen = {} # y -> (segments, spans) last drawn on stdscr, so unchanged lines are not redrawn
+screen_layout = None # (height, width, show_log, show_help) that lines_on_screen was drawn for
+log_window = None # Live log subwindow, kept until the layout changes
+log_lines_on_screen = {} # Log window row -> log entry last written there
+
+codec_cache = {}
+codec_cache_db = None
+codec_cache_lock = threading.Lock()
+idle_probe_helpers = queue.SimpleQueue() # (process, connection) pairs of long-lived PyAV probe processes
 
 # --- Helper Functions ---
+SIZE_NAMES = ("B", "KB", "MB", "GB", "TB")
+
+@lru_cache(maxsize=4096) # Sizes are redrawn every frame but rarely change
 def format_size(size_bytes):
-    if size_bytes is None or size_bytes <= 0:
+    if size_bytes is None or size_bytes < 1:
         return "0B"
-    size_name = ("B", "KB", "MB", "GB", "TB")
-    if size_bytes < 1: return "0B"
-    i = int(math.floor(math.log(size_bytes, 1024)))
-    i = max(0, min(i, len(size_name) - 1)) 
-    p = math.pow(1024, i)
-    s = round(size_bytes / p, 2)
-    return f"{s}{size_name[i]}" 
-
-def add_log_message(message):
-    timestamp = time.strftime("%Y-%m-%d %H:%M:%S")
-    log_messages.append(f"[{timestamp}] {message}")
+    i = 0
+    size = float(size_bytes)
+    while size >= 1024 and i < len(SIZE_NAMES) - 1:
+        size /= 1024
+        i += 1
+    return f"{round(size, 2)}{SIZE_NAMES[i]}" 
+
+TERMINAL_STATUSES = ("success", "skipped", "error", "cancelled", "deleted_zero", "deleted_error")
+
+def set_status(file_item, status): # Caller holds ui_lock
+    status_counts[file_item.status] -= 1
+    file_item.status = status
+    status_counts[status] += 1
+
+def all_files_finished(): # Caller holds ui_lock
+    return bool(all_files) and sum(status_counts[s] for s in TERMINAL_STATUSES) == len(all_files)
+
+def request_stop():
+    stop_event.set()
+    with encode_wakeup: encode_wakeup.notify_all()
+    pending_files_queue.put(None) # Sentinel: the preparer blocks in get() with no timeout
+    for _ in range(NUM_FFMPEG_WORKERS):
+        try: ready_for_encode_queue.put_nowait(None)
+        except queue.Full: break # Encoders are not waiting on get(); they check stop_event before taking another item
+
+def wake_ui():
+    if ui_needs_update.is_set(): return # A frame is already owed and the UI ignores the pipe until it draws it, so the write would be wasted
     ui_needs_update.set()
+    try: os.write(ui_wake_w, b'x')
+    except BlockingIOError: pass # Plenty of unread wakeups already queued
+
+def add_log_message(message, *args):
+    # Stored raw; the timestamp and any str.format(*args) are only rendered for lines that get displayed
+    log_messages.append((time.time(), message, args))
+    wake_ui()
+
+def log_tail(count): # Newest `count` entries, oldest first, without copying the whole deque
+    return list(islice(reversed(log_messages), max(0, count)))[::-1]
+
+@lru_cache(maxsize=64) # Log lines arrive in bursts within the same second
+def format_log_timestamp(logged_at_second):
+    return time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(logged_at_second))
+
+def format_log_message(entry):
+    logged_at, message, args = entry
+    if args: message = message.format(*args)
+    return f"[{format_log_timestamp(int(logged_at))}] {message}"
+
+def get_video_codec_info_pyav(filepath):
+    try:
+        with av.open(filepath, metadata_errors='ignore') as container:
+            if not container.streams.video:
+                add_log_message("PYAV: No video streams found for {}", os.path.basename(filepath))
+                return None
+            # canonical_name is the codec id name (e.g. 'av1'), matching ffprobe's codec_name rather than the decoder name
+            codec_name = container.streams.video[0].codec_context.codec.canonical_name
+        add_log_message("PYAV: Codec for {} is {}", os.path.basename(filepath), codec_name)
+        return codec_name
+    except Exception as e:
+        add_log_message("PYAV: Exception for {}: {} {}", os.path.basename(filepath), type(e).__name__, e)
+        return None
+
+def _probe_helper_main(conn):
+    # Runs in a spawned process so a libav crash on a damaged file only takes this helper down, not the TUI
+    while True:
+        try: filepath = conn.recv()
+        except EOFError: return
+        if filepath is None: return
+        codec_name = get_video_codec_info_pyav(filepath)
+        # Rendered here: lazy args such as libav exceptions need not survive pickling
+        conn.send((codec_name, [(logged_at, message.format(*args) if args else message, ()) for logged_at, message, args in log_messages]))
+        log_messages.clear()
+
+def get_video_codec_info_helper(filepath):
+    try: helper = idle_probe_helpers.get_nowait()
+    except queue.Empty: # One helper per concurrent caller, so the pool never grows past PROBE_WORKERS + the preparer
+        try:
+            ctx = multiprocessing.get_context("spawn")
+            conn, child_conn = ctx.Pipe()
+            process = ctx.Process(target=_probe_helper_main, args=(child_conn,), name="ProbeHelper", daemon=True)
+            process.start()
+            child_conn.close()
+            helper = (process, conn)
+            add_log_message("PYAV: Started probe helper process {}", process.pid)
+        except Exception as e:
+            add_log_message("PYAV: Could not start probe helper: {} {}", type(e).__name__, e)
+            return None
+    process, conn = helper
+    try:
+        conn.send(filepath)
+        if not conn.poll(PROBE_HELPER_TIMEOUT_SECONDS):
+            raise TimeoutError(f"no reply after {PROBE_HELPER_TIMEOUT_SECONDS}s")
+        codec_name, helper_logs = conn.recv()
+    except (OSError, EOFError, TimeoutError) as e:
+        add_log_message("PYAV: Probe helper {} failed on {} (exit code {}): {} {}", process.pid, os.path.basename(filepath), process.exitcode, type(e).__name__, e)
+        process.kill(); process.join(); conn.close()
+        return None
+    log_messages.extend(helper_logs)
+    idle_probe_helpers.put(helper)
+    return codec_name
+
+def shutdown_probe_helpers():
+    while True:
+        try: process, conn = idle_probe_helpers.get_nowait()
+        except queue.Empty: return
+        try: conn.send(None)
+        except OSError: pass
+        process.join(timeout=2)
+        if process.is_alive(): process.kill(); process.join()
+        conn.close()
 
 def get_video_codec_info(filepath):
+    if av is not None:
+        codec_name = get_video_codec_info_helper(filepath)
+        if codec_name: return codec_name
+        add_log_message("PYAV: Falling back to ffprobe for {}", os.path.basename(filepath))
+
     stdout = "" 
     stderr = "" 
     try:
-        command = [
-            FFPROBE_PATH, '-v', 'quiet', '-print_format', 'json',
-            '-show_streams', '-select_streams', 'v:0', filepath
-        ]
-        add_log_message(f"FFPROBE: Running for {os.path.basename(filepath)}")
-        process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True, encoding='utf-8')
-        stdout, stderr = process.communicate(timeout=30)
+        # Headers name the codec for most containers; streams like MPEG-TS only reveal it after a full stream scan, so that is the retry
+        for probe_args in (FFPROBE_QUICK_ARGS, ()):
+            command = [ # Just the first video stream's codec name as a bare line, instead of every stream field as JSON
+                FFPROBE_PATH, '-v', 'quiet', *probe_args, '-select_streams', 'v:0',
+                '-show_entries', 'stream=codec_name', '-of', 'default=noprint_wrappers=1:nokey=1', filepath
+            ]
+            add_log_message("FFPROBE: Running for {}{}", os.path.basename(filepath), ' (header only)' if probe_args else '')
+            process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True, encoding='utf-8')
+            stdout, stderr = process.communicate(timeout=30)
+            codec_name = stdout.strip()
+            if process.returncode == 0 and codec_name:
+                add_log_message("FFPROBE: Codec for {} is {}", os.path.basename(filepath), codec_name)
+                return codec_name
 
         if process.returncode == 0:
-            data = json.loads(stdout)
-            if data.get('streams') and data['streams']: 
-                codec_name = data['streams'][0].get('codec_name')
-                add_log_message(f"FFPROBE: Codec for {os.path.basename(filepath)} is {codec_name}")
-                return codec_name
-            else:
-                add_log_message(f"FFPROBE: No video streams found for {os.path.basename(filepath)}. FFprobe stdout: {stdout.strip() if stdout else '<empty>'}")
-                return None
+            add_log_message("FFPROBE: No video streams found for {}. FFprobe stdout: {}", os.path.basename(filepath), stdout.strip() if stdout else '<empty>')
+            return None
         else:
             full_error_output = f"Stdout: '{stdout.strip() if stdout else '<empty>'}' Stderr: '{stderr.strip() if stderr else '<empty>'}'"
-            add_log_message(f"FFPROBE Error for {os.path.basename(filepath)}: RC={process.returncode} Output: {full_error_output}")
+            add_log_message("FFPROBE Error for {}: RC={} Output: {}", os.path.basename(filepath), process.returncode, full_error_output)
             return None
     except subprocess.TimeoutExpired:
-        add_log_message(f"FFPROBE: Timeout for {os.path.basename(filepath)}")
-        if 'process' in locals() and hasattr(process, 'kill') and process.poll() is None:
-            process.kill()
-        return None
-    except json.JSONDecodeError as je:
-        add_log_message(f"FFPROBE: JSON decode error for {os.path.basename(filepath)}: {je}. FFprobe stdout: {stdout[:200] if stdout else '<empty>'}")
+        add_log_message("FFPROBE: Timeout for {}", os.path.basename(filepath))
+        process.kill(); process.wait() # communicate() only raises once the process exists; reap it so it does not linger as a zombie
         return None
     except Exception as e:
-        add_log_message(f"FFPROBE: Exception for {os.path.basename(filepath)}: {type(e).__name__} {e}")
+        add_log_message("FFPROBE: Exception for {}: {} {}", os.path.basename(filepath), type(e).__name__, e)
         return None
 
+def _codec_cache_key(filepath):
+    st = os.stat(filepath)
+    return f"{st.st_size}:{st.st_mtime_ns}:{os.path.abspath(filepath)}"
+
+def _get_codec_cache_db():
+    global codec_cache_db
+    if codec_cache_db is None:
+        db_path = os.path.join(TEMP_DIRECTORY, CODEC_CACHE_FILENAME)
+        try:
+            codec_cache_db = sqlite3.connect(db_path, isolation_level=None, check_same_thread=False)
+            codec_cache_db.execute("CREATE TABLE IF NOT EXISTS codecs(key TEXT PRIMARY KEY, codec TEXT)")
+        except sqlite3.Error as e:
+            add_log_message("CODEC_CACHE: Cannot open {}, using in-memory cache only: {}", db_path, e)
+            codec_cache_db = False
+    return codec_cache_db
+
+def get_cached_video_codec_info(filepath):
+    try:
+        key = _codec_cache_key(filepath)
+    except OSError as e:
+        add_log_message("CODEC_CACHE: Cannot stat {}, probing uncached: {}", os.path.basename(filepath), e)
+        return get_video_codec_info(filepath)
+
+    with codec_cache_lock:
+        codec_name = codec_cache.get(key)
+        db = _get_codec_cache_db()
+        if codec_name is None and db:
+            try:
+                row = db.execute("SELECT codec FROM codecs WHERE key = ?", (key,)).fetchone()
+                if row: codec_name = codec_cache[key] = row[0]
+            except sqlite3.Error as e:
+                add_log_message("CODEC_CACHE: Lookup failed for {}: {}", os.path.basename(filepath), e)
+    if codec_name is not None:
+        add_log_message("CODEC_CACHE: Hit for {}: {}", os.path.basename(filepath), codec_name)
+        return codec_name
+
+    codec_name = get_video_codec_info(filepath)
+    if codec_name is not None: # Failed probes are not cached so they get retried next run
+        _store_cached_codec(key, filepath, codec_name)
+    return codec_name
+
+def _store_cached_codec(key, filepath, codec_name):
+    with codec_cache_lock:
+        codec_cache[key] = codec_name
+        db = _get_codec_cache_db()
+        if db:
+            try: db.execute("INSERT OR REPLACE INTO codecs(key, codec) VALUES (?, ?)", (key, codec_name))
+            except sqlite3.Error as e: add_log_message("CODEC_CACHE: Store failed for {}: {}", os.path.basename(filepath), e)
+
+def remember_encoded_codec(filepath):
+    # The encoder knows what it just wrote, so the next run skips the file from the cache instead of probing it again
+    try: _store_cached_codec(_codec_cache_key(filepath), filepath, "av1")
+    except OSError as e: add_log_message("CODEC_CACHE: Cannot stat {} after encode: {}", os.path.basename(filepath), e)
+
+def direct_copy(src, dst):
+    # The source is read once, so its reads bypass the page cache; writes stay buffered so FFmpeg reads the staged copy hot
+    src_fd = os.open(src, os.O_RDONLY | os.O_DIRECT) # EINVAL where the filesystem has no O_DIRECT (e.g. tmpfs)
+    try:
+        size = os.fstat(src_fd).st_size
+        copied = 0
+        with mmap.mmap(-1, DIRECT_IO_CHUNK_SIZE) as buf, open(dst, 'wb') as dst_f: # Anonymous mmap is page aligned
+            with memoryview(buf) as view:
+                while True:
+                    n = os.readv(src_fd, [buf])
+                    if n: dst_f.write(view[:n]); copied += n
+                    if n < DIRECT_IO_CHUNK_SIZE: break # Reading on from an unaligned offset would fail, so any short read ends the copy
+        # FUSE/network filesystems and files still being written can return short reads before EOF; never stage a truncated copy
+        if copied != size: raise OSError(errno.EIO, f"O_DIRECT copy stopped at {copied} of {size} bytes", src)
+    finally:
+        os.close(src_fd)
+
+def fast_stage(src, dst, mode="reflink"):
+    if mode == "reflink":
+        try:
+            with open(src, 'rb') as src_f, open(dst, 'wb') as dst_f:
+                fcntl.ioctl(dst_f.fileno(), FICLONE, src_f.fileno())
+            shutil.copystat(src, dst)
+            return "reflink"
+        except OSError:
+            try: os.remove(dst) # Drop the empty file left behind by the failed clone
+            except OSError: pass
+    if mode in ("reflink", "hardlink"):
+        try:
+            os.link(src, dst) # Fails with EXDEV when the temp dir is on another filesystem
+            return "hardlink"
+        except OSError: pass
+    try:
+        direct_copy(src, dst)
+        shutil.copystat(src, dst)
+        return "direct copy"
+    except OSError:
+        try: remove_if_exists(dst) # Partial copy
+        except OSError: pass
+    try: # No O_DIRECT here (e.g. tmpfs or FUSE): copy_file_range/sendfile still avoid the userspace round trip
+        with open(src, 'rb') as src_f, open(dst, 'wb') as dst_f:
+            method = _kernel_copy(src_f.fileno(), dst_f.fileno(), os.fstat(src_f.fileno()).st_size)
+        if method:
+            shutil.copystat(src, dst)
+            return method
+    except OSError: pass
+    try: remove_if_exists(dst)
+    except OSError: pass
+    shutil.copy2(src, dst)
+    return "copy"
+
+def remove_if_exists(path): # Instead of exists() then remove(): one syscall, and no race between the two
+    try: os.remove(path)
+    except FileNotFoundError: pass
+
+def _kernel_copy(src_fd, dst_fd, size):
+    # copy_file_range can clone or copy server-side; sendfile at least keeps the bytes out of userspace
+    for method in ("copy_file_range", "sendfile"):
+        if not hasattr(os, method): continue
+        copied = 0
+        try:
+            while copied < size:
+                if method == "copy_file_range": n = os.copy_file_range(src_fd, dst_fd, size - copied)
+                else: n = os.sendfile(dst_fd, src_fd, None, size - copied)
+                if n == 0: break
+                copied += n
+        except OSError as e:
+            if copied or e.errno not in (errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP): raise
+            continue
+        if copied == size: return method
+        return None
+    return None
+
+def fast_move(src, dst):
+    try:
+        os.replace(src, dst)
+        return "rename"
+    except OSError as e:
+        if e.errno != errno.EXDEV: raise
+    # Cross-device: copy next to dst and swap it in, so an interrupted copy never leaves a truncated original
+    partial_path = dst + ".part"
+    try:
+        method = None
+        with open(src, 'rb') as src_f, open(partial_path, 'wb') as dst_f:
+            try: method = _kernel_copy(src_f.fileno(), dst_f.fileno(), os.fstat(src_f.fileno()).st_size)
+            except OSError: pass
+        if method is None:
+            shutil.copyfile(src, partial_path)
+            method = "copy"
+        shutil.copystat(src, partial_path)
+        os.replace(partial_path, dst)
+    except BaseException:
+        try: os.remove(partial_path)
+        except OSError: pass
+        raise
+    os.remove(src)
+    return method
+
+def batch_probe_codecs(paths):
+    with ThreadPoolExecutor(max_workers=PROBE_WORKERS, thread_name_prefix="Probe") as executor:
+        # Leaving the with-block waits for every queued probe, so after a stop request the rest return None without probing
+        return dict(zip(paths, executor.map(lambda path: None if stop_event.is_set() else get_cached_video_codec_info(path), paths)))
+
 # --- Worker Threads ---
+def iter_videos(root, skip_dir=None):
+    # os.scandir hands back each entry's type from the directory listing, so only accepted videos cost a stat
+    if stop_event.is_set(): return
+    try: entries = os.scandir(root)
+    except OSError as e:
+        add_log_message("SCANNER: Error listing {}: {}", root, e)
+        return
+    subdirs = []
+    with entries:
+        for entry in entries:
+            try:
+                if entry.is_dir(follow_symlinks=False):
+                    if entry.path == skip_dir: add_log_message("SCANNER: Skipping temp directory scan: {}", entry.path)
+                    else: subdirs.append(entry.path)
+                    continue
+                _, dot, ext = entry.name.rpartition('.')
+                if dot and ext.lower() in VIDEO_EXT_SET and BESIDE_SOURCE_TAG not in entry.name and entry.is_file():
+                    yield entry
+            except OSError as e:
+                add_log_message("SCANNER: Error accessing {}: {}", entry.path, e)
+    for subdir in subdirs:
+        yield from iter_videos(subdir, skip_dir)
+
 def file_scanner_worker():
     global ARGS 
-    add_log_message(f"SCANNER: Starting file scan in '{SOURCE_DIRECTORY}'")
+    add_log_message("SCANNER: Starting file scan in '{}'", SOURCE_DIRECTORY)
     file_id_counter = 0
     discovered_files_this_scan = [] 
 
     abs_source_directory = os.path.abspath(SOURCE_DIRECTORY)
     abs_temp_directory = os.path.abspath(TEMP_DIRECTORY)
-    add_log_message(f"SCANNER: Absolute source path: {abs_source_directory}")
-    add_log_message(f"SCANNER: Absolute temp path: {abs_temp_directory}")
+    add_log_message("SCANNER: Absolute source path: {}", abs_source_directory)
+    add_log_message("SCANNER: Absolute temp path: {}", abs_temp_directory)
 
-    for root, _, files in os.walk(abs_source_directory): 
-        if stop_event.is_set():
-            add_log_message("SCANNER: Stop event received, halting scan.")
-            return
-        
-        if os.path.commonpath([root, abs_temp_directory]) == abs_temp_directory:
-            add_log_message(f"SCANNER: Skipping temp directory scan: {root}")
-            continue
+    if os.path.commonpath([abs_source_directory, abs_temp_directory]) == abs_temp_directory:
+        add_log_message("SCANNER: Source directory is inside the temp directory, nothing to scan.")
+        return
 
-        for file_idx, filename in enumerate(files):
-            if stop_event.is_set():
-                add_log_message("SCANNER: Stop event received, halting scan.")
-                return
+    for entry in iter_videos(abs_source_directory, skip_dir=abs_temp_directory):
+        if stop_event.is_set(): break
+        original_path = entry.path 
+        item = None 
+        try:
+            original_size = entry.stat().st_size
+            item = FileItem(id=file_id_counter, original_path=original_path, original_size=original_size)
             
-            if filename.lower().endswith(VIDEO_EXTENSIONS):
-                original_path = os.path.join(root, filename) 
-                item = None 
+            if original_size == 0 and ARGS.delete_zeros:
+                add_log_message("SCANNER: File '{}' is 0 bytes. Deleting as per --delete-zeros.", original_path)
                 try:
-                    original_size = os.path.getsize(original_path)
-                    item = FileItem(id=file_id_counter, original_path=original_path, original_size=original_size)
-                    
-                    if original_size == 0 and ARGS.delete_zeros:
-                        add_log_message(f"SCANNER: File '{original_path}' is 0 bytes. Deleting as per --delete-zeros.")
-                        try:
-                            os.remove(original_path)
-                            add_log_message(f"SCANNER: Successfully deleted 0-byte file: {original_path}")
-                            item.status = "deleted_zero"
-                            item.status_message = "0-byte file (deleted)"
-                        except OSError as e_del:
-                            add_log_message(f"SCANNER: Error deleting 0-byte file {original_path}: {e_del}")
-                            item.status = "error" 
-                            item.status_message = "0-byte (delete failed)"
-                            item.error_details = str(e_del)
-                    
-                    discovered_files_this_scan.append(item)
-                    file_id_counter += 1
-
-                    if file_idx % 50 == 0: 
-                        with ui_lock:
-                            all_files[:] = sorted(discovered_files_this_scan, key=lambda x: x.original_path) 
-                        ui_needs_update.set()
-                        time.sleep(0.01) 
-                except OSError as e:
-                    add_log_message(f"SCANNER: Error accessing {original_path}: {e}")
-                    if item is None: 
-                        item = FileItem(id=file_id_counter, original_path=original_path, original_size=0)
-                        file_id_counter +=1
-                    item.status = "error"
-                    item.status_message = "Access error"
-                    item.error_details = str(e)
-                    discovered_files_this_scan.append(item) 
+                    os.remove(original_path)
+                    add_log_message("SCANNER: Successfully deleted 0-byte file: {}", original_path)
+                    item.status = "deleted_zero"
+                    item.status_message = "0-byte file (deleted)"
+                except OSError as e_del:
+                    add_log_message("SCANNER: Error deleting 0-byte file {}: {}", original_path, e_del)
+                    item.status = "error" 
+                    item.status_message = "0-byte (delete failed)"
+                    item.error_details = str(e_del)
+            elif original_size == 0 and not ARGS.delete_errors: # Nothing to probe or encode; --delete-errors still gets to delete it after the failed probe
+                item.status = "error"
+                item.status_message = "0-byte file"
+                item.error_details = "File is empty."
+            
+            discovered_files_this_scan.append(item)
+            file_id_counter += 1
+
+            if file_id_counter % 50 == 0: 
+                # Publish and queue in discovery order while scanning, so encoding starts before a big tree is fully walked; the one sort happens when the scan finishes
+                with ui_lock:
+                    new_items = discovered_files_this_scan[len(all_files):]
+                    all_files.extend(new_items)
+                    status_counts.update(item.status for item in new_items)
+                for item_to_queue in new_items:
+                    if item_to_queue.status == "pending": pending_files_queue.put(item_to_queue)
+                wake_ui()
+                time.sleep(0.01) 
+        except OSError as e:
+            add_log_message("SCANNER: Error accessing {}: {}", original_path, e)
+            if item is None: 
+                item = FileItem(id=file_id_counter, original_path=original_path, original_size=0)
+                file_id_counter +=1
+            item.status = "error"
+            item.status_message = "Access error"
+            item.error_details = str(e)
+            discovered_files_this_scan.append(item) 
+
+    if stop_event.is_set():
+        add_log_message("SCANNER: Stop event received, halting scan.")
+        return
     
     with ui_lock:
-        all_files[:] = sorted(discovered_files_this_scan, key=lambda x: x.original_path) 
-        pending_files_queue.clear() 
-        
-        for item_to_queue in all_files:
-            if item_to_queue.status == "pending": 
-                pending_files_queue.append(item_to_queue)
+        new_items = discovered_files_this_scan[len(all_files):]
+        all_files.extend(new_items)
+        status_counts.update(item.status for item in new_items)
+        all_files.sort(key=lambda x: x.original_path)
+    items_to_probe = [item for item in discovered_files_this_scan if item.status == "pending"] # Discovery order, the order the preparer takes them from the queue
+    for item_to_queue in new_items:
+        if item_to_queue.status == "pending": pending_files_queue.put(item_to_queue)
             
-    add_log_message(f"SCANNER: Found {len(all_files)} video files. Queued {len(pending_files_queue)} for processing.")
-    ui_needs_update.set()
+    add_log_message("SCANNER: Found {} video files. {} still pending.", len(all_files), len(items_to_probe))
+    wake_ui()
+
+    # Probe codecs ahead of the preparer so its per-file check is usually just a lookup
+    probed_count = 0
+    for batch_start in range(0, len(items_to_probe), PROBE_BATCH_SIZE):
+        if stop_event.is_set():
+            add_log_message("SCANNER: Stop event received, halting codec pre-probe.")
+            return
+        with ui_lock: # Claimed under the lock the preparer takes to move an item out of "pending", so a file is probed by one side only
+            batch = [item for item in items_to_probe[batch_start:batch_start + PROBE_BATCH_SIZE]
+                     if item.status == "pending" and item.input_codec is None and item.probe_done is None]
+            for item in batch: item.probe_done = threading.Event()
+        if not batch: continue
+        try:
+            codecs = batch_probe_codecs([item.original_path for item in batch])
+            if stop_event.is_set(): return # Probes skipped for the stop also came back as None; they must not be recorded as failures
+            for item in batch:
+                if item.input_codec is None: item.input_codec = codecs.get(item.original_path) or CODEC_PROBE_FAILED
+        finally:
+            for item in batch: item.probe_done.set()
+        probed_count += len(batch)
+    add_log_message("SCANNER: Pre-probed codecs for {} files.", probed_count)
 
 def file_preparer_worker():
     global ARGS
     while not stop_event.is_set():
-        with ui_lock:
-            no_pending_in_queue = not pending_files_queue
-            all_system_files_processed_past_pending = all(f.status != "pending" for f in all_files)
-            other_queues_empty = not ready_for_encode_queue and not encoding_files_list and not preparing_files_list
-
-        if no_pending_in_queue and all_system_files_processed_past_pending and other_queues_empty:
-            add_log_message("PREPARER: No pending files and other queues empty. Preparer idling.")
-            time.sleep(2)
-            continue
-        elif no_pending_in_queue: 
-            time.sleep(0.5)
-            continue
+        file_item = pending_files_queue.get()
+        if file_item is None: break # request_stop()
 
         with ui_lock:
-            num_being_readied = len(ready_for_encode_queue) + len(preparing_files_list)
-            num_can_prepare = NUM_FILES_TO_PREPARE - num_being_readied
-            
-        if num_can_prepare <= 0:
-            time.sleep(0.2)
-            continue
-
-        try:
-            with ui_lock:
-                if not pending_files_queue: continue
-                file_item = pending_files_queue.popleft()
-                if file_item.status in ["cancelled", "deleted_zero", "deleted_error"]: 
-                    add_log_message(f"PREPARER: Skipped item {file_item.filename} from pending queue due to status: {file_item.status}.")
-                    continue 
-                preparing_files_list.append(file_item)
-        except IndexError: 
-            time.sleep(0.1)
-            continue
+            if file_item.status in ["cancelled", "deleted_zero", "deleted_error"]: 
+                add_log_message("PREPARER: Skipped item {} from pending queue due to status: {}.", file_item.filename, file_item.status)
+                continue 
+            preparing_files.add(file_item)
         
         try:
             with ui_lock:
                 if file_item.status in ["cancelled", "skipped", "error", "success", "deleted_zero", "deleted_error"]: 
-                    if file_item in preparing_files_list: preparing_files_list.remove(file_item)
-                    add_log_message(f"PREPARER: Item {file_item.filename} already in terminal/skip state '{file_item.status}', removing from preparing.")
+                    preparing_files.discard(file_item)
+                    add_log_message("PREPARER: Item {} already in terminal/skip state '{}', removing from preparing.", file_item.filename, file_item.status)
                     continue
-                file_item.status = "checking"
+                set_status(file_item, "checking")
                 file_item.status_message = "ffprobe"
-            ui_needs_update.set()
+                probe_in_flight = file_item.probe_done
+            wake_ui()
 
-            codec = get_video_codec_info(file_item.original_path)
+            if probe_in_flight: probe_in_flight.wait() # The scanner's pre-probe has this file; probing it here as well would run it twice at once
+            if stop_event.is_set(): break
+            codec = file_item.input_codec
+            if codec is None: codec = get_cached_video_codec_info(file_item.original_path)
             with ui_lock:
-                if file_item not in preparing_files_list and file_item.status == "cancelled": 
-                    add_log_message(f"PREPARER: Item {file_item.filename} was cancelled during ffprobe check, not proceeding.")
+                if file_item not in preparing_files and file_item.status == "cancelled": 
+                    add_log_message("PREPARER: Item {} was cancelled during ffprobe check, not proceeding.", file_item.filename)
                     continue 
             
             file_item.input_codec = codec
@@ -279,127 +621,149 @@ def file_preparer_worker():
             if stop_event.is_set(): break
             with ui_lock: 
                 if file_item.status == "cancelled": 
-                    add_log_message(f"PREPARER: Item {file_item.filename} cancelled during ffprobe. Skipping copy.")
-                    if file_item in preparing_files_list: preparing_files_list.remove(file_item)
+                    add_log_message("PREPARER: Item {} cancelled during ffprobe. Skipping copy.", file_item.filename)
+                    preparing_files.discard(file_item)
                     continue
 
             if codec == 'av1':
                 with ui_lock:
-                    file_item.status = "skipped"
+                    set_status(file_item, "skipped")
                     file_item.status_message = "Already AV1"
-                    if file_item in preparing_files_list: preparing_files_list.remove(file_item)
-                ui_needs_update.set()
-                add_log_message(f"PREPARER: Skipped {file_item.filename}, already AV1.")
+                    preparing_files.discard(file_item)
+                wake_ui()
+                add_log_message("PREPARER: Skipped {}, already AV1.", file_item.filename)
                 continue
             
-            if codec is None: 
+            if not codec: # None from the probe above, or CODEC_PROBE_FAILED from the scanner's pre-probe
                 with ui_lock:
-                    file_item.status = "error" 
+                    set_status(file_item, "error")
                     file_item.status_message = "ffprobe failed"
                     if not file_item.error_details: 
                          file_item.error_details = "ffprobe failed to determine codec or file is invalid."
                     
                     if ARGS.delete_errors: 
-                        add_log_message(f"PREPARER: --delete-errors active. Attempting to delete original source '{file_item.original_path}' due to ffprobe error.")
+                        add_log_message("PREPARER: --delete-errors active. Attempting to delete original source '{}' due to ffprobe error.", file_item.original_path)
                         try:
                             os.remove(file_item.original_path)
-                            add_log_message(f"PREPARER: Successfully deleted original source '{file_item.original_path}' due to ffprobe error.")
-                            file_item.status = "deleted_error" 
+                            add_log_message("PREPARER: Successfully deleted original source '{}' due to ffprobe error.", file_item.original_path)
+                            set_status(file_item, "deleted_error")
                             file_item.status_message = "ffprobe error (deleted)"
                         except OSError as e_del:
-                            add_log_message(f"PREPARER: Error deleting original source '{file_item.original_path}' after ffprobe error: {e_del}")
+                            add_log_message("PREPARER: Error deleting original source '{}' after ffprobe error: {}", file_item.original_path, e_del)
                             file_item.status_message = "ffprobe error (del failed)" 
                             file_item.error_details += f" | Delete failed: {e_del}"
                     
-                    if file_item in preparing_files_list: preparing_files_list.remove(file_item)
-                ui_needs_update.set()
-                add_log_message(f"PREPARER: Error checking codec for {file_item.filename}. File status: {file_item.status}.")
+                    preparing_files.discard(file_item)
+                wake_ui()
+                add_log_message("PREPARER: Error checking codec for {}. File status: {}.", file_item.filename, file_item.status)
                 continue 
 
             qsv_decoder_map = {"h264": "h264_qsv", "hevc": "hevc_qsv", "mpeg2video": "mpeg2_qsv", "vp9": "vp9_qsv"}
             file_item.qsv_input_codec = qsv_decoder_map.get(codec)
             if not file_item.qsv_input_codec:
                 file_item.use_cpu_decode = True 
-                add_log_message(f"PREPARER: No direct QSV decoder for {codec} on {file_item.filename}. Will try CPU decode to QSV surface.")
+                add_log_message("PREPARER: No direct QSV decoder for {} on {}. Will try CPU decode to QSV surface.", codec, file_item.filename)
 
-            with ui_lock: 
-                if file_item.status == "cancelled": 
-                    add_log_message(f"PREPARER: Item {file_item.filename} cancelled before copy. Skipping.")
-                    if file_item in preparing_files_list: preparing_files_list.remove(file_item)
-                    continue
-                file_item.status = "transferring_to_temp"
-                file_item.status_message = "Copying..."
-            ui_needs_update.set()
+            if not ARGS.no_stage:
+                with ui_lock: 
+                    if file_item.status == "cancelled": 
+                        add_log_message("PREPARER: Item {} cancelled before copy. Skipping.", file_item.filename)
+                        preparing_files.discard(file_item)
+                        continue
+                    set_status(file_item, "transferring_to_temp")
+                    file_item.status_message = "Copying..."
+                wake_ui()
 
-            os.makedirs(TEMP_DIRECTORY, exist_ok=True)
-            temp_source_filename = f"{file_item.id}_{file_item.filename}"
-            file_item.temp_source_path = os.path.join(TEMP_DIRECTORY, temp_source_filename)
+                os.makedirs(TEMP_DIRECTORY, exist_ok=True)
+                temp_source_filename = f"{file_item.id}_{file_item.filename}"
+                file_item.temp_source_path = os.path.join(TEMP_DIRECTORY, temp_source_filename)
 
-            add_log_message(f"PREPARER: Copying {file_item.filename} to {file_item.temp_source_path}")
-            shutil.copy2(file_item.original_path, file_item.temp_source_path)
-            add_log_message(f"PREPARER: Copied {file_item.filename} to temp.")
+                add_log_message("PREPARER: Staging {} to {}", file_item.filename, file_item.temp_source_path)
+                stage_method = fast_stage(file_item.original_path, file_item.temp_source_path, ARGS.stage_mode)
+                add_log_message("PREPARER: Staged {} to temp via {}.", file_item.filename, stage_method)
 
             with ui_lock:
                  if file_item.status == "cancelled": 
-                    add_log_message(f"PREPARER: Item {file_item.filename} cancelled during copy. Cleaning up temp source.")
-                    if file_item.temp_source_path and os.path.exists(file_item.temp_source_path):
-                        try: os.remove(file_item.temp_source_path)
-                        except OSError as oe: add_log_message(f"PREPARER: Error cleaning temp source for item cancelled during copy: {oe}")
-                    if file_item in preparing_files_list: preparing_files_list.remove(file_item)
+                    add_log_message("PREPARER: Item {} cancelled during copy. Cleaning up temp source.", file_item.filename)
+                    if file_item.temp_source_path:
+                        try: remove_if_exists(file_item.temp_source_path)
+                        except OSError as oe: add_log_message("PREPARER: Error cleaning temp source for item cancelled during copy: {}", oe)
+                    preparing_files.discard(file_item)
+                    continue
+                 set_status(file_item, "ready")
+                 file_item.status_message = "In temp" if file_item.temp_source_path else "Direct from source"
+                 preparing_files.discard(file_item)
+            wake_ui()
+
+            # Blocks while the encoder is behind, so the next copy overlaps the current encode instead of racing ahead
+            while not stop_event.is_set():
+                try:
+                    ready_for_encode_queue.put(file_item, timeout=0.5)
+                    wake_ui() # Again now it is queued, or the Ready count and Next entries lag until some other update
+                    break
+                except queue.Full:
                     continue
-                 file_item.status = "ready"
-                 file_item.status_message = "In temp"
-                 if file_item in preparing_files_list: preparing_files_list.remove(file_item)
-                 ready_for_encode_queue.append(file_item)
-            ui_needs_update.set()
 
         except Exception as e:
             with ui_lock:
-                file_item.status = "error"
+                set_status(file_item, "error")
                 file_item.status_message = "Preparation failed"
                 file_item.error_details = str(e)
-                if file_item in preparing_files_list: preparing_files_list.remove(file_item)
-            add_log_message(f"PREPARER: Error preparing {file_item.filename}: {e}")
-            ui_needs_update.set()
-            if file_item.temp_source_path and os.path.exists(file_item.temp_source_path):
-                try: os.remove(file_item.temp_source_path)
-                except OSError as oe: add_log_message(f"PREPARER: Error cleaning up temp file {file_item.temp_source_path}: {oe}")
-        time.sleep(0.05)
+                preparing_files.discard(file_item)
+            add_log_message("PREPARER: Error preparing {}: {}", file_item.filename, e)
+            wake_ui()
+            if file_item.temp_source_path:
+                try: remove_if_exists(file_item.temp_source_path)
+                except OSError as oe: add_log_message("PREPARER: Error cleaning up temp file {}: {}", file_item.temp_source_path, oe)
     add_log_message("PREPARER: Shutting down.")
 
-def ffmpeg_encoder_worker():
+def pin_encoder_thread(worker_index):
+    # Affinity set on this thread is inherited by every FFmpeg it starts; sessions get neighbouring, non-overlapping CPUs while there are enough
+    available_cpus = sorted(os.sched_getaffinity(0))
+    first = worker_index * ARGS.pin_cpus
+    cpus = {available_cpus[(first + i) % len(available_cpus)] for i in range(ARGS.pin_cpus)}
+    try: os.sched_setaffinity(0, cpus)
+    except OSError as e:
+        add_log_message("ENCODER: Could not pin {} to CPUs {}: {}", threading.current_thread().name, sorted(cpus), e)
+        return
+    add_log_message("ENCODER: {} pinned to CPUs {}", threading.current_thread().name, sorted(cpus))
+
+def build_ffmpeg_templates():
+    # Everything in the FFmpeg command except the input codec and the two paths is fixed for the run
+    global FFMPEG_COMMAND_PREFIX, FFMPEG_CPU_DECODE_ARGS, FFMPEG_OUTPUT_ARGS
+    FFMPEG_COMMAND_PREFIX = (FFMPEG_PATH, *FFMPEG_BASE_ARGS, '-filter_threads', str(FFMPEG_SESSION_THREADS))
+    FFMPEG_CPU_DECODE_ARGS = ('-threads', str(ARGS.ffmpeg_threads or min(CPU_DECODE_THREADS, FFMPEG_SESSION_THREADS)),
+                              '-hwaccel', 'qsv', '-hwaccel_output_format', 'qsv', '-i')
+    FFMPEG_OUTPUT_ARGS = (*AV1_QSV_ENCODE_ARGS, '-preset', ARGS.qsv_preset,
+                          *(('-look_ahead_depth', str(LOOKAHEAD_DEPTH)) if ARGS.lookahead else ()),
+                          '-threads', str(FFMPEG_SESSION_THREADS), *AUDIO_COPY_ARGS)
+
+@lru_cache(maxsize=None)
+def qsv_decode_args(qsv_input_codec):
+    return ('-hwaccel', 'qsv', '-qsv_device', QSV_DEVICE, '-c:v', qsv_input_codec, '-i')
+
+def ffmpeg_encoder_worker(worker_index=0):
     global ARGS 
-    ffmpeg_encoder_worker.last_q_len = -1
-    ffmpeg_encoder_worker.last_enc_list_len = -1
+    idle_logged = False
+    if ARGS.pin_cpus: pin_encoder_thread(worker_index)
 
     while not stop_event.is_set():
-        current_encoding_item = None
-        with ui_lock:
-            q_len = len(ready_for_encode_queue)
-            enc_list_len = len(encoding_files_list)
-            if q_len != ffmpeg_encoder_worker.last_q_len or enc_list_len != ffmpeg_encoder_worker.last_enc_list_len :
-                add_log_message(f"ENCODER_LOOP_START: ReadyQ: {q_len}, EncodingList: {enc_list_len}, MaxWorkers: {NUM_FFMPEG_WORKERS}")
-                ffmpeg_encoder_worker.last_q_len = q_len
-                ffmpeg_encoder_worker.last_enc_list_len = enc_list_len
-            
-            if ready_for_encode_queue and len(encoding_files_list) < NUM_FFMPEG_WORKERS:
-                current_encoding_item = ready_for_encode_queue.popleft()
-                encoding_files_list.append(current_encoding_item)
-                add_log_message(f"ENCODER_PICKED: Picked '{current_encoding_item.filename}'. EncodingList size: {len(encoding_files_list)}, ReadyQ size: {len(ready_for_encode_queue)}")
-        
-        if not current_encoding_item:
-            time.sleep(0.2) 
+        try:
+            current_encoding_item = ready_for_encode_queue.get(timeout=0.5) # Timeout only for the idle check below; request_stop() sends None
+        except queue.Empty:
             with ui_lock:
-                if not pending_files_queue and not preparing_files_list and not ready_for_encode_queue and not encoding_files_list:
-                    all_terminal = True
-                    for f_item_check in all_files:
-                        if f_item_check.status not in ["success", "skipped", "error", "cancelled", "deleted_zero", "deleted_error"]:
-                            all_terminal = False; break
-                    if all_terminal:
+                if not idle_logged and all_files and pending_files_queue.empty() and not preparing_files and not encoding_files:
+                    if all_files_finished():
                         add_log_message("ENCODER: All files processed. Encoder idling.")
-                        time.sleep(2) 
+                        idle_logged = True
             continue
 
+        if current_encoding_item is None: break
+        idle_logged = False
+        with ui_lock:
+            encoding_files.add(current_encoding_item)
+            add_log_message("ENCODER_PICKED: Picked '{}'. encoding set size: {}, ReadyQ size: {}", current_encoding_item.filename, len(encoding_files), ready_for_encode_queue.qsize())
+
         file_item = current_encoding_item
         original_filename_for_log = file_item.filename 
         process = None 
@@ -412,81 +776,93 @@ def ffmpeg_encoder_worker():
                     is_already_cancelled_or_deleted = True
             
             if is_already_cancelled_or_deleted:
-                add_log_message(f"ENCODER: Item '{file_item.filename}' was already in terminal state '{file_item.status}' when picked. Cleaning up temp source if any.")
-                if file_item.temp_source_path and os.path.exists(file_item.temp_source_path):
+                add_log_message("ENCODER: Item '{}' was already in terminal state '{}' when picked. Cleaning up temp source if any.", file_item.filename, file_item.status)
+                if file_item.temp_source_path:
                     try: 
-                        os.remove(file_item.temp_source_path)
-                        add_log_message(f"ENCODER: Cleaned temp source for pre-terminal item: {file_item.temp_source_path}")
-                    except Exception as e_clean: add_log_message(f"ENCODER: Error cleaning temp source for pre-terminal '{file_item.filename}': {e_clean}")
+                        remove_if_exists(file_item.temp_source_path)
+                        add_log_message("ENCODER: Cleaned temp source for pre-terminal item: {}", file_item.temp_source_path)
+                    except Exception as e_clean: add_log_message("ENCODER: Error cleaning temp source for pre-terminal '{}': {}", file_item.filename, e_clean)
             else: 
                 with ui_lock:
-                    file_item.status = "encoding"
+                    set_status(file_item, "encoding")
                     file_item.status_message = "FFmpeg running"
-                    file_item.encoding_start_time = time.time() # Set encoding start time
-                ui_needs_update.set()
-
-                base, ext = os.path.splitext(file_item.temp_source_path)
-                file_item.temp_encoded_path = base + "_av1" + ext 
+                    file_item.encoding_start_time = time.monotonic() # Set encoding start time
+                wake_ui()
+
+                # With --no-stage there is no temp source: ffmpeg reads the original and only the output lands in temp
+                input_path = file_item.temp_source_path or file_item.original_path
+                if ARGS.output_beside_source: # Same directory as the original, so moving it back is a rename
+                    base, ext = os.path.splitext(file_item.original_path)
+                    file_item.temp_encoded_path = os.path.join(os.path.dirname(base), f".{os.path.basename(base)}{BESIDE_SOURCE_TAG}{ext}")
+                else:
+                    base, ext = os.path.splitext(file_item.temp_source_path or os.path.join(TEMP_DIRECTORY, f"{file_item.id}_{file_item.filename}"))
+                    file_item.temp_encoded_path = base + "_av1" + ext 
 
-                add_log_message(f"ENCODER: Starting FFmpeg for {file_item.filename}")
+                add_log_message("ENCODER: Starting FFmpeg for {}", file_item.filename)
                 
-                ffmpeg_command_list = [FFMPEG_PATH] + list(FFMPEG_BASE_ARGS)
-                if file_item.use_cpu_decode or not file_item.qsv_input_codec:
-                    ffmpeg_command_list.extend(['-hwaccel', 'qsv', '-hwaccel_output_format', 'qsv', '-i', file_item.temp_source_path])
-                else:
-                    ffmpeg_command_list.extend(['-hwaccel', 'qsv', '-qsv_device', QSV_DEVICE, 
-                                                 '-c:v', file_item.qsv_input_codec, '-i', file_item.temp_source_path])
-                ffmpeg_command_list.extend(AV1_QSV_ENCODE_ARGS)
-                ffmpeg_command_list.extend(AUDIO_COPY_ARGS)
-                ffmpeg_command_list.append(file_item.temp_encoded_path)
+                decode_args = FFMPEG_CPU_DECODE_ARGS if file_item.use_cpu_decode or not file_item.qsv_input_codec else qsv_decode_args(file_item.qsv_input_codec)
+                ffmpeg_command_list = [*FFMPEG_COMMAND_PREFIX, *decode_args, input_path, *FFMPEG_OUTPUT_ARGS, file_item.temp_encoded_path]
 
-                add_log_message(f"FFMPEG CMD_LIST: {' '.join(ffmpeg_command_list)}")
+                add_log_message("FFMPEG CMD_LIST: {}", ' '.join(ffmpeg_command_list))
                 
                 # start_time already set when status became "encoding"
-                process = subprocess.Popen(ffmpeg_command_list, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True, encoding='utf-8')
+                process = subprocess.Popen(ffmpeg_command_list, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True, encoding='utf-8', errors='replace')
                 
+                # A waiter thread drains stderr and notifies on exit, so this thread sleeps until FFmpeg exits,
+                # the user cancels, the app stops or the timeout expires, instead of polling.
+                # Only the tail is kept: a damaged input can make FFmpeg log an error for every frame
+                ffmpeg_output = []
+                def collect_ffmpeg_output(process=process, ffmpeg_output=ffmpeg_output):
+                    with process.stderr: stderr_tail = deque(process.stderr, maxlen=FFMPEG_STDERR_TAIL_LINES)
+                    process.wait()
+                    ffmpeg_output.extend(("", "".join(stderr_tail)))
+                    with encode_wakeup: encode_wakeup.notify_all()
+                waiter = threading.Thread(target=collect_ffmpeg_output, name=f"{threading.current_thread().name}Wait", daemon=True)
+                waiter.start()
+
                 user_initiated_cancel_detected_in_poll = False
                 app_stop_event_detected_in_poll = False
 
-                while process.poll() is None:
-                    if stop_event.is_set():
-                        app_stop_event_detected_in_poll = True
-                        add_log_message(f"ENCODER: App stop event detected for FFmpeg on '{file_item.filename}'. Terminating.")
-                        process.terminate()
-                        break 
-                    with ui_lock: 
+                with encode_wakeup:
+                    while not ffmpeg_output:
+                        if stop_event.is_set():
+                            app_stop_event_detected_in_poll = True; break
                         if file_item.status == "cancelled":
-                            user_initiated_cancel_detected_in_poll = True
-                    if user_initiated_cancel_detected_in_poll:
-                        add_log_message(f"ENCODER: User cancellation detected for FFmpeg on '{file_item.filename}'. Terminating.")
-                        process.terminate()
-                        break
-                    
-                    if FFMPEG_ENCODE_TIMEOUT_SECONDS > 0 and \
-                       file_item.encoding_start_time is not None and \
-                       (time.time() - file_item.encoding_start_time) > FFMPEG_ENCODE_TIMEOUT_SECONDS:
-                        add_log_message(f"ENCODER: FFmpeg timeout for '{file_item.filename}' after {FFMPEG_ENCODE_TIMEOUT_SECONDS}s. Terminating.")
-                        process.terminate()
-                        timed_out = True
-                        break
-                    time.sleep(0.1)
+                            user_initiated_cancel_detected_in_poll = True; break
+                        remaining = None
+                        if FFMPEG_ENCODE_TIMEOUT_SECONDS > 0 and file_item.encoding_start_time is not None:
+                            remaining = file_item.encoding_start_time + FFMPEG_ENCODE_TIMEOUT_SECONDS - time.monotonic()
+                            if remaining <= 0:
+                                timed_out = True; break
+                        encode_wakeup.wait(timeout=remaining)
+
+                if app_stop_event_detected_in_poll:
+                    add_log_message("ENCODER: App stop event detected for FFmpeg on '{}'. Terminating.", file_item.filename)
+                    process.terminate()
+                elif user_initiated_cancel_detected_in_poll:
+                    add_log_message("ENCODER: User cancellation detected for FFmpeg on '{}'. Terminating.", file_item.filename)
+                    process.terminate()
+                elif timed_out:
+                    add_log_message("ENCODER: FFmpeg timeout for '{}' after {}s. Terminating.", file_item.filename, FFMPEG_ENCODE_TIMEOUT_SECONDS)
+                    process.terminate()
                 
                 if not timed_out:
                     if app_stop_event_detected_in_poll or user_initiated_cancel_detected_in_poll:
-                        try:
-                            add_log_message(f"ENCODER: Waiting for FFmpeg on '{file_item.filename}' to terminate (cancel/stop)...")
-                            process.wait(timeout=10) 
-                            add_log_message(f"ENCODER: FFmpeg on '{file_item.filename}' terminated with RC={process.returncode}.")
-                        except subprocess.TimeoutExpired:
-                            add_log_message(f"ENCODER: FFmpeg for '{file_item.filename}' did not terminate gracefully (cancel/stop), killing.")
-                            process.kill(); process.wait() 
-                            add_log_message(f"ENCODER: FFmpeg for '{file_item.filename}' killed.")
+                        add_log_message("ENCODER: Waiting for FFmpeg on '{}' to terminate (cancel/stop)...", file_item.filename)
+                        waiter.join(timeout=10)
+                        if waiter.is_alive():
+                            add_log_message("ENCODER: FFmpeg for '{}' did not terminate gracefully (cancel/stop), killing.", file_item.filename)
+                            process.kill(); waiter.join()
+                            add_log_message("ENCODER: FFmpeg for '{}' killed.", file_item.filename)
+                        else:
+                            add_log_message("ENCODER: FFmpeg on '{}' terminated with RC={}.", file_item.filename, process.returncode)
                     
-                    stdout_data, stderr_data = process.communicate() 
+                    waiter.join()
+                    stdout_data, stderr_data = ffmpeg_output
                     return_code = process.returncode
                 else: 
-                    try: process.wait(timeout=10)
-                    except subprocess.TimeoutExpired: process.kill(); process.wait()
+                    waiter.join(timeout=10)
+                    if waiter.is_alive(): process.kill(); waiter.join()
                     stdout_data, stderr_data = "", "FFmpeg process timed out." 
                     return_code = -9 
                 
@@ -497,47 +873,40 @@ def ffmpeg_encoder_worker():
 
                 if timed_out:
                     with ui_lock:
-                        file_item.status = "error"
+                        set_status(file_item, "error")
                         file_item.status_message = "FFmpeg Timeout"
                         file_item.error_details = f"Process exceeded timeout of {FFMPEG_ENCODE_TIMEOUT_SECONDS}s."
-                    add_log_message(f"ENCODER: '{file_item.filename}' marked as error due to timeout.")
+                    add_log_message("ENCODER: '{}' marked as error due to timeout.", file_item.filename)
                 elif final_status_is_user_cancelled:
-                    add_log_message(f"ENCODER: Confirmed cancelled status for '{file_item.filename}' post-FFmpeg (RC={return_code}). Cleaning up.")
+                    add_log_message("ENCODER: Confirmed cancelled status for '{}' post-FFmpeg (RC={}). Cleaning up.", file_item.filename, return_code)
                 elif app_stop_event_detected_in_poll: 
                     with ui_lock:
-                        file_item.status = "error"; file_item.status_message = "Interrupted (app exit)"
+                        set_status(file_item, "error"); file_item.status_message = "Interrupted (app exit)"
                         file_item.error_details = f"Process stopped by application exit. FFmpeg RC={return_code}"
-                    add_log_message(f"ENCODER: Marked '{file_item.filename}' as interrupted due to app exit. RC={return_code}")
+                    add_log_message("ENCODER: Marked '{}' as interrupted due to app exit. RC={}", file_item.filename, return_code)
                 elif return_code == 0: 
-                    add_log_message(f"ENCODER: FFmpeg success for {file_item.filename}")
-                    if not os.path.exists(file_item.temp_encoded_path):
+                    add_log_message("ENCODER: FFmpeg success for {}", file_item.filename)
+                    try: file_item.encoded_size = os.stat(file_item.temp_encoded_path).st_size # One stat both checks the output and sizes it
+                    except FileNotFoundError: file_item.encoded_size = None
+                    if file_item.encoded_size is None:
                          with ui_lock:
-                            file_item.status = "error"; file_item.status_message = "Output missing"
+                            set_status(file_item, "error"); file_item.status_message = "Output missing"
                             file_item.error_details = f"FFmpeg success but output {file_item.temp_encoded_path} missing."
-                         add_log_message(f"ENCODER: ERROR - FFmpeg success but output missing for {file_item.filename}")
+                         add_log_message("ENCODER: ERROR - FFmpeg success but output missing for {}", file_item.filename)
                     else: 
-                        file_item.encoded_size = os.path.getsize(file_item.temp_encoded_path)
-                        if file_item.temp_source_path and os.path.exists(file_item.temp_source_path): os.remove(file_item.temp_source_path)
-                        final_temp_name = os.path.splitext(file_item.temp_source_path)[0] + file_item.extension 
-                        shutil.move(file_item.temp_encoded_path, final_temp_name)
-                        file_item.temp_encoded_path = None 
-                        with ui_lock: file_item.status = "transferring_to_source"; file_item.status_message = "Moving..."
-                        ui_needs_update.set()
-                        os.makedirs(os.path.dirname(file_item.original_path), exist_ok=True)
-                        add_log_message(f"ENCODER: Moving {final_temp_name} to {file_item.original_path}")
-                        shutil.move(final_temp_name, file_item.original_path)
-                        with ui_lock: file_item.status = "success"; file_item.status_message = "AV1 Encoded"
-                        add_log_message(f"ENCODER: Successfully processed and replaced {file_item.filename}")
+                        if file_item.temp_source_path: remove_if_exists(file_item.temp_source_path)
+                        with ui_lock: set_status(file_item, "transferring_to_source"); file_item.status_message = "Queued for move"
+                        finalize_queue.put(file_item)
                 else: 
                     err_msg = stderr_data.strip() if stderr_data else stdout_data.strip()
                     with ui_lock:
-                        file_item.status = "error"; file_item.status_message = "FFmpeg failed"
+                        set_status(file_item, "error"); file_item.status_message = "FFmpeg failed"
                         file_item.error_details = f"FFmpeg Error (code {return_code}): {err_msg}"
-                    add_log_message(f"ENCODER: FFmpeg error for '{file_item.filename}'. Code: {return_code}. Stderr: {err_msg[:500]}") 
+                    add_log_message("ENCODER: FFmpeg error for '{}'. Code: {}. Stderr: {}", file_item.filename, return_code, err_msg[:500]) 
                 
                 if file_item.status != "success" and file_item.status != "transferring_to_source":
-                    if file_item.temp_encoded_path and os.path.exists(file_item.temp_encoded_path): os.remove(file_item.temp_encoded_path)
-                    if file_item.temp_source_path and os.path.exists(file_item.temp_source_path): os.remove(file_item.temp_source_path)
+                    if file_item.temp_encoded_path: remove_if_exists(file_item.temp_encoded_path)
+                    if file_item.temp_source_path: remove_if_exists(file_item.temp_source_path)
                 
                 # Reset encoding_start_time after processing (success or failure)
                 with ui_lock:
@@ -545,41 +914,59 @@ def ffmpeg_encoder_worker():
         
         except Exception as e: 
             with ui_lock:
-                file_item.status = "error"; file_item.status_message = "Processing exception"
+                set_status(file_item, "error"); file_item.status_message = "Processing exception"
                 file_item.error_details = str(e)
                 file_item.encoding_start_time = None # Reset on exception too
-            add_log_message(f"ENCODER: Exception processing '{original_filename_for_log}': {type(e).__name__} {e}")
+            add_log_message("ENCODER: Exception processing '{}': {} {}", original_filename_for_log, type(e).__name__, e)
             if process and process.poll() is None:
-                add_log_message(f"ENCODER: Terminating FFmpeg for '{original_filename_for_log}' due to exception.")
+                add_log_message("ENCODER: Terminating FFmpeg for '{}' due to exception.", original_filename_for_log)
                 process.terminate()
                 try: process.wait(timeout=5)
                 except subprocess.TimeoutExpired: process.kill()
-            if hasattr(file_item,'temp_source_path') and file_item.temp_source_path and os.path.exists(file_item.temp_source_path):
-                try: os.remove(file_item.temp_source_path)
-                except Exception: pass
-            if hasattr(file_item,'temp_encoded_path') and file_item.temp_encoded_path and os.path.exists(file_item.temp_encoded_path):
-                try: os.remove(file_item.temp_encoded_path)
-                except Exception: pass
+            for temp_path in (file_item.temp_source_path, file_item.temp_encoded_path): # FileItem always has both fields
+                if not temp_path: continue
+                try: remove_if_exists(temp_path)
+                except OSError: pass
         finally:
             with ui_lock:
-                if file_item in encoding_files_list: 
-                    encoding_files_list.remove(file_item)
-                    add_log_message(f"ENCODER_FINALLY: Removed '{original_filename_for_log}' from EncodingList. Size now: {len(encoding_files_list)}")
-                    ffmpeg_encoder_worker.last_enc_list_len = len(encoding_files_list) 
+                if file_item in encoding_files: 
+                    encoding_files.remove(file_item)
+                    add_log_message("ENCODER_FINALLY: Removed '{}' from encoding set. Size now: {}", original_filename_for_log, len(encoding_files))
                 else:
-                    add_log_message(f"ENCODER_FINALLY: Item '{original_filename_for_log}' was NOT in EncodingList.")
-            ui_needs_update.set()
-            time.sleep(0.01) 
+                    add_log_message("ENCODER_FINALLY: Item '{}' was NOT in encoding set.", original_filename_for_log)
+            wake_ui()
     add_log_message("ENCODER: Shutting down.")
 
+def file_finalizer_worker():
+    while True:
+        file_item = finalize_queue.get()
+        if file_item is None: break
+        try:
+            with ui_lock: file_item.status_message = "Moving..."
+            wake_ui()
+            os.makedirs(os.path.dirname(file_item.original_path), exist_ok=True)
+            add_log_message("FINALIZER: Moving {} to {}", file_item.temp_encoded_path, file_item.original_path)
+            move_method = fast_move(file_item.temp_encoded_path, file_item.original_path)
+            add_log_message("FINALIZER: Moved {} back to source via {}.", file_item.filename, move_method)
+            remember_encoded_codec(file_item.original_path)
+            file_item.temp_encoded_path = None
+            with ui_lock: set_status(file_item, "success"); file_item.status_message = "AV1 Encoded"
+            add_log_message("FINALIZER: Successfully processed and replaced {}", file_item.filename)
+        except Exception as e:
+            with ui_lock:
+                set_status(file_item, "error"); file_item.status_message = "Move failed"
+                file_item.error_details = str(e)
+            add_log_message("FINALIZER: Exception moving '{}' back: {} {}", file_item.filename, type(e).__name__, e)
+            if file_item.temp_encoded_path: remove_if_exists(file_item.temp_encoded_path)
+        wake_ui()
+    add_log_message("FINALIZER: Shutting down.")
+
 # --- Curses UI ---
 CP_SUCCESS, CP_TRANSFERRING, CP_ENCODING_TEXT_COLOR, CP_ERROR, CP_READY, CP_DEFAULT_PENDING, \
 CP_SELECTED, CP_CANCELLED_SKIPPED_BASE, CP_ENCODING_HIGHLIGHT_BG, CP_DELETED, CP_TIMEOUT_TEXT = range(1, 12) # Added CP_TIMEOUT_TEXT
 
-def draw_ui(stdscr, current_selection_idx, scroll_offset, show_help, show_log, window_height, window_width):
-    global spinner_index
-    stdscr.erase()
-    
+def init_ui_colors(): # After the color pairs are set up; draw_ui only reads the results
+    global COLOR_DEFAULT, COLOR_SELECTED, COLOR_ENCODING_HIGHLIGHT_BG, COLOR_DELETED, COLOR_TIMEOUT_TEXT, status_color_map
     color_pairs = {i: curses.color_pair(i) for i in range(1, 12)} 
     COLOR_SUCCESS = color_pairs.get(CP_SUCCESS, curses.A_NORMAL) 
     COLOR_TRANSFERRING = color_pairs.get(CP_TRANSFERRING, curses.A_NORMAL)
@@ -593,7 +980,6 @@ def draw_ui(stdscr, current_selection_idx, scroll_offset, show_help, show_log, w
     COLOR_DELETED = color_pairs.get(CP_DELETED, curses.A_NORMAL)
     COLOR_TIMEOUT_TEXT = color_pairs.get(CP_TIMEOUT_TEXT, curses.A_BOLD) # Fallback to A_BOLD
 
-
     status_color_map = {
         "success": COLOR_SUCCESS, 
         "skipped": COLOR_CANCELLED_SKIPPED_BASE_ATTR, 
@@ -605,53 +991,70 @@ def draw_ui(stdscr, current_selection_idx, scroll_offset, show_help, show_log, w
         "deleted_zero": COLOR_DELETED, "deleted_error": COLOR_DELETED,
     }
 
-    # --- Header ---
-    base_header_text = "AV1 Batch Encoder | F1: Help | F2: Log | 'c': Cancel | PgUp/PgDn | Q: Quit"
-    timeout_display_str = ""
-    
-    with ui_lock:
-        current_encoding_item_for_header = encoding_files_list[0] if encoding_files_list else None
-
-    if current_encoding_item_for_header and \
-       current_encoding_item_for_header.encoding_start_time is not None and \
-       FFMPEG_ENCODE_TIMEOUT_SECONDS > 0:
-        elapsed_time = time.time() - current_encoding_item_for_header.encoding_start_time
-        remaining_time = FFMPEG_ENCODE_TIMEOUT_SECONDS - elapsed_time
-        if remaining_time < 0: remaining_time = 0
-        minutes = int(remaining_time // 60)
-        seconds = int(remaining_time % 60)
-        timeout_display_str = f"Timeout: {minutes:02d}:{seconds:02d}"
+def format_timeout_remaining(encoding_start_time):
+    if encoding_start_time is None or FFMPEG_ENCODE_TIMEOUT_SECONDS <= 0: return ""
+    return format_countdown(max(0, int(FFMPEG_ENCODE_TIMEOUT_SECONDS - (time.monotonic() - encoding_start_time))))
+
+@lru_cache(maxsize=4) # Redrawn every tick, but the text only changes once a second
+def format_countdown(remaining_seconds):
+    return f"Timeout: {remaining_seconds // 60:02d}:{remaining_seconds % 60:02d}"
+
+def spinner_char(): # One step per UI tick off the clock, so the speed does not depend on how often frames are drawn
+    return SPINNER_CHARS[int(time.monotonic() / UI_TICK_SECONDS) % len(SPINNER_CHARS)]
+
+def draw_ticker(stdscr):
+    # Between full redraws only the spinner and the timeout countdown move; touch just those cells
+    spinner_cell = ticker_cells.get('spinner')
+    if spinner_cell:
+        y, x, attr = spinner_cell
+        try: stdscr.addstr(y, x, spinner_char(), attr)
+        except curses.error: pass
+        lines_on_screen.pop(y, None) # The shadow no longer matches this line
+    timeout_cell = ticker_cells.get('timeout')
+    if timeout_cell:
+        x, attr, encoding_start_time = timeout_cell
+        try: stdscr.addstr(0, x, format_timeout_remaining(encoding_start_time), attr)
+        except curses.error: pass
+        lines_on_screen.pop(0, None)
+    stdscr.noutrefresh()
+    curses.doupdate()
+
+def draw_line(stdscr, y, segments, spans=()):
+    # spans are (x, length, attr) recolored with chgat after the text is written
+    if lines_on_screen.get(y) == (segments, spans): return
+    lines_on_screen[y] = (segments, spans)
+    try:
+        stdscr.move(y, 0); stdscr.clrtoeol()
+        last_x = stdscr.getmaxyx()[1] - 1 # Text is clipped here by addnstr, so callers need not slice it
+        for x, text, attr in segments:
+            if x < last_x: stdscr.addnstr(y, x, text, last_x - x, attr)
+        for x, length, attr in spans: stdscr.chgat(y, x, length, attr)
+    except curses.error: pass
+
+@lru_cache(maxsize=4096) # The same names and statuses are fitted to the same widths frame after frame
+def fit_text(text, width):
+    if len(text) <= width: return text
+    return text[:width-3] + "..." if width > 3 else text[:max(0, width)]
+
+@lru_cache(maxsize=1024) # Display strings are memoized per item, so rows hit this every frame until they change or the window is resized
+def fit_row(base_filename, size_details_str, status_text_str, available_width):
+    status_text_str = fit_text(status_text_str, 30)
+    size_details_str = fit_text(size_details_str, 35)
+    right_part = " ".join(part for part in (size_details_str, status_text_str) if part)
+    space_for_filename = available_width - len(size_details_str) - len(status_text_str) - (1 if size_details_str else 0) - (1 if status_text_str else 0)
+    if space_for_filename <= 3: filename_display = "..." if space_for_filename > 0 else ""
+    else: filename_display = fit_text(base_filename, space_for_filename)
+    return f"{filename_display}{right_part:>{max(1 + len(right_part), available_width - len(filename_display))}}"
 
-    header_to_draw = base_header_text
-    if timeout_display_str:
-        # Adjust header length if timeout is shown
-        available_for_main_header = window_width - 1 - len(timeout_display_str) - 2 # -2 for spacing
-        if len(header_to_draw) > available_for_main_header and available_for_main_header > 0 :
-            header_to_draw = header_to_draw[:available_for_main_header-3] + "..." if available_for_main_header > 3 else header_to_draw[:available_for_main_header]
-        elif available_for_main_header <=0: # Not enough space for main header at all
-             header_to_draw = ""
+def draw_ui(stdscr, current_selection_idx, scroll_offset, show_help, show_log, window_height, window_width):
+    global screen_layout, log_window
+    layout = (window_height, window_width, show_log, show_help)
+    if layout != screen_layout: # Resize or a view toggle: start from a blank screen
+        stdscr.erase()
+        lines_on_screen.clear()
+        log_window = None
+        screen_layout = layout
     
-    stdscr.addstr(0, 0, header_to_draw[:window_width-1], curses.A_BOLD)
-    if timeout_display_str:
-        try:
-            stdscr.addstr(0, window_width - 1 - len(timeout_display_str), timeout_display_str, COLOR_TIMEOUT_TEXT | curses.A_BOLD)
-        except curses.error: pass # If window too small
-
-
-    # --- Summary ---
-    with ui_lock:
-        s_pending = sum(1 for f in all_files if f.status == "pending")
-        s_ready_q_len = len(ready_for_encode_queue)
-        s_encoding_list_len = len(encoding_files_list)
-        s_success = sum(1 for f in all_files if f.status == "success")
-        s_skipped = sum(1 for f in all_files if f.status == "skipped")
-        s_error = sum(1 for f in all_files if f.status == "error")
-        s_cancelled = sum(1 for f in all_files if f.status == "cancelled")
-        s_deleted = sum(1 for f in all_files if f.status in ["deleted_zero", "deleted_error"])
-        s_total = len(all_files)
-    summary_text = f"Total: {s_total} | Pend: {s_pending} | Ready: {s_ready_q_len} | Enc: {s_encoding_list_len} | Done: {s_success+s_skipped} (S:{s_success},K:{s_skipped}) | Err: {s_error} | Canc: {s_cancelled} | Del: {s_deleted}"
-    stdscr.addstr(1, 0, summary_text[:window_width-1])
-
     view_area_start_y = 2
     available_height_for_views = window_height - view_area_start_y - BOTTOM_STATUS_LINES
     
@@ -667,24 +1070,61 @@ def draw_ui(stdscr, current_selection_idx, scroll_offset, show_help, show_log, w
     list_area_height = max(1, list_area_height)
     log_area_height = max(0, log_area_height)
 
+    # Copy everything this frame shows in one go, then format and draw without holding up the workers
     with ui_lock:
-        num_files = len(all_files)
+        encoding_item = min(encoding_files, key=lambda f: f.id) if encoding_files else None
+        header_encoding_start_time = encoding_item.encoding_start_time if encoding_item else None
+        s_pending = status_counts["pending"]
+        s_encoding_list_len = len(encoding_files)
+        s_success = status_counts["success"]
+        s_skipped = status_counts["skipped"]
+        s_error = status_counts["error"]
+        s_cancelled = status_counts["cancelled"]
+        s_deleted = status_counts["deleted_zero"] + status_counts["deleted_error"]
+        num_files = s_total = len(all_files)
         if num_files == 0: visible_files = []
         else:
             current_selection_idx = max(0, min(current_selection_idx, num_files - 1))
             scroll_offset = max(0, min(scroll_offset, num_files - list_area_height if num_files > list_area_height else 0))
-            visible_files = all_files[scroll_offset : scroll_offset + list_area_height]
+            visible_files = [(f.status,) + f.get_display_strings() for f in all_files[scroll_offset : scroll_offset + list_area_height]]
+        display_logs = log_tail(log_area_height - 2) if show_log and log_area_height > 1 else []
+    with ready_for_encode_queue.mutex: # Peek without consuming; the encoder owns get()
+        ready_items = list(ready_for_encode_queue.queue)[:2]
+    s_ready_q_len = len(ready_for_encode_queue.queue)
 
-    for i, file_item in enumerate(visible_files):
-        y_pos = i + view_area_start_y 
-        if y_pos >= view_area_start_y + list_area_height: break 
+    # --- Header ---
+    base_header_text = "AV1 Batch Encoder | F1: Help | F2: Log | 'c': Cancel | PgUp/PgDn | Q: Quit"
+    ticker_cells.clear()
+    timeout_display_str = format_timeout_remaining(header_encoding_start_time)
 
-        base_filename, size_details_str, status_text_str = file_item.get_display_strings()
+    header_to_draw = base_header_text
+    if timeout_display_str:
+        # Adjust header length if timeout is shown
+        available_for_main_header = window_width - 1 - len(timeout_display_str) - 2 # -2 for spacing
+        header_to_draw = fit_text(header_to_draw, available_for_main_header)
+    
+    header_segments = ((0, header_to_draw, curses.A_BOLD),)
+    if timeout_display_str and window_width - 1 - len(timeout_display_str) >= 0:
+        header_segments += ((window_width - 1 - len(timeout_display_str), timeout_display_str, COLOR_TIMEOUT_TEXT | curses.A_BOLD),)
+        ticker_cells['timeout'] = (window_width - 1 - len(timeout_display_str), COLOR_TIMEOUT_TEXT | curses.A_BOLD, header_encoding_start_time)
+    draw_line(stdscr, 0, header_segments)
+
+
+    # --- Summary ---
+    summary_text = f"Total: {s_total} | Pend: {s_pending} | Ready: {s_ready_q_len} | Enc: {s_encoding_list_len} | Done: {s_success+s_skipped} (S:{s_success},K:{s_skipped}) | Err: {s_error} | Canc: {s_cancelled} | Del: {s_deleted}"
+    draw_line(stdscr, 1, ((0, summary_text, curses.A_NORMAL),))
+
+    for i in range(list_area_height):
+        y_pos = i + view_area_start_y 
+        if i >= len(visible_files):
+            draw_line(stdscr, y_pos, ())
+            continue
+        file_status, base_filename, size_details_str, status_text_str = visible_files[i]
         
-        line_attr = status_color_map.get(file_item.status, COLOR_DEFAULT)
-        if file_item.status == "cancelled" or file_item.status == "skipped": 
+        line_attr = status_color_map.get(file_status, COLOR_DEFAULT)
+        if file_status == "cancelled" or file_status == "skipped": 
             line_attr |= curses.A_DIM
-        elif file_item.status == "encoding": 
+        elif file_status == "encoding": 
              line_attr |= curses.A_BOLD
         
         actual_idx_in_all_files = scroll_offset + i
@@ -692,55 +1132,21 @@ def draw_ui(stdscr, current_selection_idx, scroll_offset, show_help, show_log, w
 
         cursor_char = ">" if actual_idx_in_all_files == current_selection_idx and line_attr != COLOR_SELECTED else " "
         
-        available_width = window_width - 1 - len(cursor_char) 
-        max_status_len = 30 
-        if len(status_text_str) > max_status_len:
-            status_text_str = status_text_str[:max_status_len-3] + "..."
-        
-        max_size_details_len = 35 
-        if len(size_details_str) > max_size_details_len:
-            size_details_str = size_details_str[:max_size_details_len-3] + "..."
-
-        space_for_filename = available_width - len(size_details_str) - len(status_text_str) - (1 if size_details_str else 0) - (1 if status_text_str else 0)
-        
-        filename_display = base_filename
-        if space_for_filename <= 3: 
-            filename_display = "..." if space_for_filename > 0 else ""
-        elif len(base_filename) > space_for_filename:
-            filename_display = base_filename[:space_for_filename-3] + "..."
-        
-        line_parts = [cursor_char, filename_display]
-        current_line_len = len(cursor_char) + len(filename_display)
-        
-        right_part = ""
-        if size_details_str:
-            right_part += size_details_str
-        if status_text_str:
-            if right_part: right_part += " " 
-            right_part += status_text_str
-        
-        padding_len = available_width - len(filename_display) - len(right_part)
-        padding_len = max(1, padding_len) 
-
-        line_parts.append(" " * padding_len)
-        line_parts.append(right_part)
-            
-        full_line = "".join(line_parts)
-        
-        try: 
-            stdscr.addstr(y_pos, 0, full_line[:window_width-1], line_attr)
-        except curses.error: pass 
+        full_line = cursor_char + fit_row(base_filename, size_details_str, status_text_str, window_width - 1 - len(cursor_char))
+        draw_line(stdscr, y_pos, ((0, full_line, line_attr),))
 
     if show_log and log_area_height > 1:
-        log_win = stdscr.subwin(log_area_height, window_width, log_display_start_y, 0)
-        log_win.erase(); log_win.box()
-        log_win.addstr(0, 2, "Live Log (F2 to close)", curses.A_BOLD)
-        with ui_lock: display_logs = list(log_messages)[- (log_area_height - 2) :] 
-        for i, msg in enumerate(display_logs):
-            if i + 1 < log_area_height -1: 
-                try: log_win.addstr(i + 1, 1, msg[:window_width-2])
-                except curses.error: pass 
-        log_win.refresh()
+        if log_window is None:
+            log_window = stdscr.subwin(log_area_height, window_width, log_display_start_y, 0)
+            log_window.box()
+            log_window.addstr(0, 2, "Live Log (F2 to close)", curses.A_BOLD)
+            log_lines_on_screen.clear()
+        for i in range(log_area_height - 2): # Only rows whose entry changed are formatted and rewritten
+            msg = display_logs[i] if i < len(display_logs) else None
+            if i in log_lines_on_screen and log_lines_on_screen[i] is msg: continue
+            log_lines_on_screen[i] = msg
+            try: log_window.addnstr(i + 1, 1, (format_log_message(msg) if msg else "").ljust(window_width-2), window_width-2)
+            except curses.error: pass 
 
     bottom_panel_start_y = window_height - BOTTOM_STATUS_LINES
     try:
@@ -748,10 +1154,8 @@ def draw_ui(stdscr, current_selection_idx, scroll_offset, show_help, show_log, w
     except curses.error: pass 
 
 
-    with ui_lock:
-        encoding_item = encoding_files_list[0] if encoding_files_list else None
-        ready_item1 = ready_for_encode_queue[0] if len(ready_for_encode_queue) > 0 else None
-        ready_item2 = ready_for_encode_queue[1] if len(ready_for_encode_queue) > 1 else None
+    ready_item1 = ready_items[0] if len(ready_items) > 0 else None
+    ready_item2 = ready_items[1] if len(ready_items) > 1 else None
 
     status_lines_data = [
         ("Encoding:", encoding_item),
@@ -759,8 +1163,7 @@ def draw_ui(stdscr, current_selection_idx, scroll_offset, show_help, show_log, w
         ("Next #2: ", ready_item2)
     ]
     
-    current_spinner_char = SPINNER_CHARS[spinner_index % len(SPINNER_CHARS)]
-    spinner_index +=1
+    current_spinner_char = spinner_char()
 
     for i, (label, item) in enumerate(status_lines_data):
         line_y = bottom_panel_start_y + 1 + i
@@ -786,27 +1189,23 @@ def draw_ui(stdscr, current_selection_idx, scroll_offset, show_help, show_log, w
             left_part = f"{label}{item_display_name}"
             right_part = status_txt_item
 
-            max_left_len = window_width - 1 - len(right_part) -1 
-            if len(left_part) > max_left_len and max_left_len > 3:
-                left_part = left_part[:max_left_len-3] + "..."
-            elif len(left_part) > max_left_len:
-                 left_part = left_part[:max_left_len]
+            left_part = fit_text(left_part, window_width - 1 - len(right_part) - 1)
             
             padding = window_width - 1 - len(left_part) - len(right_part)
             padding = max(0, padding)
 
             full_line_text = f"{left_part}{' '*padding}{right_part}"
 
-            try:
-                if label == "Encoding:":
-                     stdscr.addstr(line_y, 0, full_line_text.ljust(window_width-1)[:window_width-1], display_line_attr)
-                else: 
-                    stdscr.addstr(line_y, 0, left_part[:window_width -1 -len(right_part) -1], COLOR_DEFAULT) 
-                    stdscr.addstr(line_y, window_width -1 - len(right_part), right_part, item_status_color_for_text) 
-            except curses.error: pass
+            if label == "Encoding:":
+                draw_line(stdscr, line_y, ((0, full_line_text.ljust(window_width-1), display_line_attr),))
+                if len(left_part) + padding < window_width - 1:
+                    ticker_cells['spinner'] = (line_y, len(left_part) + padding, display_line_attr)
+            else: 
+                # One write for the whole line, then recolor just the status text
+                draw_line(stdscr, line_y, ((0, full_line_text, COLOR_DEFAULT),),
+                          ((window_width - 1 - len(right_part), len(right_part), item_status_color_for_text),) if len(right_part) < window_width - 1 else ())
         else:
-            try: stdscr.addstr(line_y, 0, (label + " <none>")[:window_width-1], COLOR_DEFAULT)
-            except curses.error: pass
+            draw_line(stdscr, line_y, ((0, label + " <none>", COLOR_DEFAULT),))
 
 
     if show_help:
@@ -816,47 +1215,56 @@ def draw_ui(stdscr, current_selection_idx, scroll_offset, show_help, show_log, w
         help_win.border(); help_win.addstr(1, 2, "Help (F1 to close)", curses.A_BOLD)
         help_win.addstr(3, 2, "Up/Down Arrows: Scroll file list"); help_win.addstr(4, 2, "PgUp/PgDn: Page scroll")
         help_win.addstr(5, 2, "'c' or 'C': Cancel processing for selected file"); help_win.addstr(6, 2, "F2: Toggle live log view")
-        help_win.addstr(7, 2, "'q' or 'Q': Quit the application"); help_win.refresh()
+        help_win.addstr(7, 2, "'q' or 'Q': Quit the application")
 
-    stdscr.refresh()
+    # Queue every window's changes, then write them to the terminal in one go
+    stdscr.noutrefresh()
+    if show_log and log_area_height > 1: log_window.noutrefresh()
+    if show_help: help_win.noutrefresh()
+    curses.doupdate()
 
 def cleanup_all_temp_files():
-    add_log_message(f"CLEANUP: Starting final cleanup of TEMP_DIRECTORY: {TEMP_DIRECTORY}")
+    add_log_message("CLEANUP: Starting final cleanup of TEMP_DIRECTORY: {}", TEMP_DIRECTORY)
     cleaned_count = 0
     error_count = 0
     
     files_to_check_for_cleanup = set()
     with ui_lock: 
         for item in all_files:
+            if item.status == "transferring_to_source": continue # Finished encode not moved back yet (e.g. the wait for the finalizer was interrupted); keep it
             if item.temp_source_path:
                 files_to_check_for_cleanup.add(item.temp_source_path)
             if item.temp_encoded_path: 
                 files_to_check_for_cleanup.add(item.temp_encoded_path)
 
-    abs_temp_directory = os.path.abspath(TEMP_DIRECTORY)
+    temp_directory_prefix = os.path.join(os.path.abspath(TEMP_DIRECTORY), "") # Trailing separator so /tmp/x does not match /tmp/xy
 
     for f_path in list(files_to_check_for_cleanup): 
-        if f_path and os.path.exists(f_path) and os.path.isfile(f_path):
-            if os.path.commonpath([os.path.abspath(f_path), abs_temp_directory]) == abs_temp_directory:
+        if f_path and os.path.isfile(f_path):
+            if os.path.abspath(f_path).startswith(temp_directory_prefix) or BESIDE_SOURCE_TAG in os.path.basename(f_path):
                 try:
                     os.remove(f_path)
-                    add_log_message(f"CLEANUP: Removed temp file: {f_path}")
+                    add_log_message("CLEANUP: Removed temp file: {}", f_path)
                     cleaned_count += 1
                 except OSError as e:
-                    add_log_message(f"CLEANUP: Error removing temp file {f_path}: {e}")
+                    add_log_message("CLEANUP: Error removing temp file {}: {}", f_path, e)
                     error_count += 1
             else:
-                add_log_message(f"CLEANUP: Skipped removing {f_path} as it's not confirmed to be in TEMP_DIRECTORY.")
+                add_log_message("CLEANUP: Skipped removing {} as it's not confirmed to be in TEMP_DIRECTORY.", f_path)
     
     if cleaned_count > 0 or error_count > 0:
-        add_log_message(f"CLEANUP: Finished. Removed {cleaned_count} files. Errors: {error_count}.")
+        add_log_message("CLEANUP: Finished. Removed {} files. Errors: {}.", cleaned_count, error_count)
     else:
         add_log_message("CLEANUP: Finished. No orphaned temp files found based on FileItem records.")
 
 
+def run_worker(target, done_event, *args):
+    try: target(*args)
+    finally: done_event.set() # Lets the UI check for finished workers without polling Thread.is_alive()
+
 def curses_main(stdscr):
-    global stop_event, all_files, pending_files_queue, ready_for_encode_queue, encoding_files_list, preparing_files_list, spinner_index
-    curses.curs_set(0); stdscr.nodelay(1); stdscr.timeout(100) 
+    global stop_event, all_files, encoding_files, preparing_files
+    curses.curs_set(0); stdscr.nodelay(1); stdscr.timeout(0) # Waiting happens in select() below
 
     if curses.has_colors():
         curses.start_color()
@@ -885,26 +1293,40 @@ def curses_main(stdscr):
             curses.init_pair(CP_DELETED, curses.COLOR_WHITE, curses.COLOR_BLACK) 
             curses.init_pair(CP_TIMEOUT_TEXT, curses.COLOR_WHITE, curses.COLOR_BLACK) # Fallback for timeout text
     
+    init_ui_colors()
+
     current_selection_idx, scroll_offset, show_help, show_log = 0, 0, False, False
-    spinner_index = 0 
     try: os.makedirs(TEMP_DIRECTORY, exist_ok=True)
     except OSError as e:
         print(f"Fatal: Cannot create TEMP_DIR {TEMP_DIRECTORY}: {e}\n", file=sys.stderr)
         return 
 
-    threads = [
-        threading.Thread(target=file_scanner_worker, daemon=True, name="ScannerThread"),
-        threading.Thread(target=file_preparer_worker, daemon=True, name="PreparerThread"),
-        threading.Thread(target=ffmpeg_encoder_worker, daemon=True, name="EncoderThread")
-    ]
+    worker_targets = [(file_scanner_worker, "ScannerThread", ()), (file_preparer_worker, "PreparerThread", ())] + \
+                     [(ffmpeg_encoder_worker, f"EncoderThread{i + 1}", (i,)) for i in range(NUM_FFMPEG_WORKERS)] + \
+                     [(file_finalizer_worker, "FinalizerThread", ())]
+    threads_done = [threading.Event() for _ in worker_targets] # Same order as threads
+    threads = [threading.Thread(target=run_worker, args=(target, done_event, *args), daemon=True, name=name)
+               for (target, name, args), done_event in zip(worker_targets, threads_done)]
     
     try:
         stop_event.clear()
         for t in threads: t.start()
         add_log_message("UI: Threads started.")
-        last_update_time = time.time()
+        last_update_time = time.monotonic()
+        key = -1
+        completion_logged = False
 
         while not stop_event.is_set():
+            # Sleep until a key, a worker's wake_ui() or the next ticker frame; after a key, poll again straight away in case curses buffered more.
+            # Once a frame is owed, further wakeups are folded into it so a burst of log lines costs one redraw per UI_MIN_FRAME_SECONDS
+            if key != -1: select_timeout = 0
+            elif ui_needs_update.is_set(): select_timeout = max(0, UI_MIN_FRAME_SECONDS - (time.monotonic() - last_update_time))
+            else: select_timeout = max(0, UI_TICK_SECONDS - (time.monotonic() - last_update_time))
+            readable, _, _ = select.select([sys.stdin] if ui_needs_update.is_set() else [sys.stdin, ui_wake_r], [], [], select_timeout)
+            if ui_wake_r in readable:
+                try: os.read(ui_wake_r, 4096)
+                except BlockingIOError: pass
+
             window_height, window_width = stdscr.getmaxyx()
             
             view_area_start_y_calc = 2
@@ -921,7 +1343,7 @@ def curses_main(stdscr):
                 ui_needs_update.set() 
                 if show_help:
                     if key == curses.KEY_F1: show_help = False
-                elif key in (ord('q'), ord('Q')): add_log_message("UI: Quit signal received."); stop_event.set(); break
+                elif key in (ord('q'), ord('Q')): add_log_message("UI: Quit signal received."); request_stop(); break
                 elif key == curses.KEY_F1: show_help = True
                 elif key == curses.KEY_F2: show_log = not show_log
                 elif key == curses.KEY_UP:
@@ -959,19 +1381,17 @@ def curses_main(stdscr):
                         if 0 <= current_selection_idx < len(all_files):
                             item_to_cancel = all_files[current_selection_idx]
                             if item_to_cancel.status not in ["success", "skipped", "error", "cancelled", "deleted_zero", "deleted_error"]:
-                                item_to_cancel.status = "cancelled"
+                                set_status(item_to_cancel, "cancelled")
                                 item_to_cancel.status_message = "User cancelled"
-                                add_log_message(f"UI: Signalled cancel for '{item_to_cancel.filename}'")
-                                if item_to_cancel in preparing_files_list: 
-                                    try: preparing_files_list.remove(item_to_cancel)
-                                    except ValueError: pass 
-                                if item_to_cancel in ready_for_encode_queue: 
-                                    try: ready_for_encode_queue.remove(item_to_cancel)
-                                    except ValueError: pass 
-                            else: add_log_message(f"UI: Cannot cancel '{item_to_cancel.filename}', status: {item_to_cancel.status}")
+                                add_log_message("UI: Signalled cancel for '{}'", item_to_cancel.filename)
+                                encode_wakeup.notify_all()
+                                preparing_files.discard(item_to_cancel)
+                                # Cancelled items still sitting in the pending/ready queues are dropped by the worker that dequeues them
+                            else: add_log_message("UI: Cannot cancel '{}', status: {}", item_to_cancel.filename, item_to_cancel.status)
             
-            current_time = time.time()
-            if ui_needs_update.is_set() or (current_time - last_update_time > 0.1): 
+            current_time = time.monotonic()
+            if ui_needs_update.is_set() and (key != -1 or current_time - last_update_time >= UI_MIN_FRAME_SECONDS): # Set by workers on real state changes and by every key press above
+                ui_needs_update.clear() # Before drawing, so a change made mid-draw triggers the next frame
                 if not show_help: 
                     with ui_lock: num_files = len(all_files)
                     if num_files > 0: 
@@ -985,49 +1405,53 @@ def curses_main(stdscr):
                             scroll_offset = max(0, min(scroll_offset, max_possible_scroll))
 
                     draw_ui(stdscr, current_selection_idx, scroll_offset, show_help, show_log, window_height, window_width)
-                ui_needs_update.clear()
+                last_update_time = current_time
+            elif current_time - last_update_time >= UI_TICK_SECONDS and not show_help and not ui_needs_update.is_set():
+                draw_ticker(stdscr)
                 last_update_time = current_time
             
-            with ui_lock:
-                no_active_tasks_in_queues = not pending_files_queue and not ready_for_encode_queue and not encoding_files_list and not preparing_files_list
-                all_items_in_terminal_state = all(f.status in ["success", "skipped", "error", "cancelled", "deleted_zero", "deleted_error"] for f in all_files) if all_files else False
-                scanner_thread_inactive = not threads[0].is_alive()
-
-            if scanner_thread_inactive and no_active_tasks_in_queues and (all_items_in_terminal_state or not all_files) :
-                 time.sleep(0.5) 
-                 with ui_lock: 
-                     final_check_queues = not pending_files_queue and not ready_for_encode_queue and not encoding_files_list and not preparing_files_list
-                     preparer_inactive = not threads[1].is_alive()
-                     encoder_inactive = not threads[2].is_alive()
-
-                 if final_check_queues and preparer_inactive and encoder_inactive:
-                    if len(all_files) > 0 : 
-                        add_log_message("UI: All tasks complete. You can press Q to quit.")
+            # The preparer, encoders and finalizer wait for work until stop, so completion is judged from the items alone.
+            # Every status change wakes this loop, so there is no need to sleep and re-check
+            if not completion_logged and threads_done[0].is_set():
+                with ui_lock: all_tasks_complete = bool(all_files) and all_files_finished() and not encoding_files and not preparing_files
+                if all_tasks_complete:
+                    completion_logged = True
+                    add_log_message("UI: All tasks complete. You can press Q to quit.")
     finally:
         add_log_message("UI: Main loop ended or exception. Ensuring stop event is set for threads.")
-        stop_event.set() 
+        request_stop()
 
         add_log_message("UI: Waiting for threads to join...")
         for i, t in enumerate(threads):
             if t.is_alive(): 
-                add_log_message(f"UI: Joining {t.name}...")
+                add_log_message("UI: Joining {}...", t.name)
+                if worker_targets[i][0] is file_finalizer_worker: # No timeout: cleanup below would delete the finished encodes still waiting to be moved
+                    finalize_queue.put(None) # Only now, after the encoders, so it lands behind every encode they handed over
+                    with ui_lock: moves_left = status_counts["transferring_to_source"]
+                    if moves_left: add_log_message("UI: Waiting for {} finished encode(s) to be moved back to the source...", moves_left)
+                    t.join()
+                    continue
+                if worker_targets[i][0] is ffmpeg_encoder_worker: # No timeout: the finalizer's sentinel must come after every handoff, and stop already terminates FFmpeg
+                    t.join()
+                    continue
                 t.join(timeout= (5 if i==0 else 12) ) 
                 if t.is_alive():
-                     add_log_message(f"UI: {t.name} did not join in time.")
+                     add_log_message("UI: {} did not join in time.", t.name)
         add_log_message("UI: All threads joined or timed out.")
         
+        shutdown_probe_helpers()
         cleanup_all_temp_files() 
     
         add_log_message("UI: Exiting.")
         if stdscr: 
             stdscr.erase()
-            final_logs = list(log_messages)[-(window_height-1 if 'window_height' in locals() else 10):] 
+            window_height, window_width = stdscr.getmaxyx() # Current size, even if the loop exited before its first frame
+            final_logs = log_tail(window_height-1)
             for i, msg in enumerate(final_logs): 
-                if i < (window_height-1 if 'window_height' in locals() else 10) : 
-                    try: stdscr.addstr(i,0, msg[:(window_width-1 if 'window_width' in locals() else 79)])
-                    except curses.error: pass 
+                try: stdscr.addnstr(i, 0, format_log_message(msg), window_width-1)
+                except curses.error: pass 
             try:
-                last_line_y = max(0,min(len(final_logs), (window_height-1 if 'window_height' in locals() else 10)))
+                last_line_y = max(0, min(len(final_logs), window_height-1))
                 stdscr.addstr(last_line_y, 0, "Exited. Press any key.", curses.A_BOLD)
                 stdscr.refresh()
                 stdscr.nodelay(0) 
@@ -1046,7 +1470,77 @@ if __name__ == '__main__':
         action='store_true', 
         help="Delete original source files if they are found to be 0 bytes during scan."
     )
+    parser.add_argument(
+        '--stage-mode',
+        choices=['reflink', 'hardlink', 'copy'],
+        default='reflink',
+        help="How files are staged into TEMP_DIRECTORY. 'reflink' tries a copy-on-write clone, then a hardlink, then a full copy; "
+             "'hardlink' skips the clone attempt; 'copy' always does a full copy (default: reflink)."
+    )
+    parser.add_argument(
+        '--no-stage',
+        action='store_true',
+        help="Do not stage source files in TEMP_DIRECTORY; FFmpeg reads the original directly and only the encoded output is written to temp."
+    )
+    parser.add_argument(
+        '--output-beside-source',
+        action='store_true',
+        help="Write each encode to a hidden file next to its original instead of TEMP_DIRECTORY, so replacing the original is a rename rather than a copy back across filesystems."
+    )
+    parser.add_argument(
+        '--qsv-sessions',
+        type=int,
+        default=NUM_FFMPEG_WORKERS,
+        metavar='N',
+        help=f"Number of FFmpeg av1_qsv encodes to run concurrently (default: {NUM_FFMPEG_WORKERS})."
+    )
+    parser.add_argument(
+        '--ffmpeg-threads',
+        type=int,
+        default=FFMPEG_THREADS,
+        metavar='N',
+        help=f"Value passed to FFmpeg's -threads and -filter_threads options; 0 splits the usable CPUs evenly between the QSV sessions. Also sets the decoder threads for inputs without a QSV decoder (default: {FFMPEG_THREADS})."
+    )
+    parser.add_argument(
+        '--qsv-preset',
+        choices=QSV_PRESETS,
+        default=QSV_PRESET,
+        help=f"av1_qsv speed/quality preset (default: {QSV_PRESET})."
+    )
+    parser.add_argument(
+        '--lookahead',
+        action=argparse.BooleanOptionalAction,
+        default=False,
+        help=f"Enable {LOOKAHEAD_DEPTH}-frame encoder look-ahead: better rate control at a cost in encode speed (default: off)."
+    )
+    parser.add_argument(
+        '--pin-cpus',
+        type=int,
+        default=0,
+        metavar='N',
+        help="Pin each encode session, and the FFmpeg processes it starts, to its own N CPUs so the CPU side of QSV stays on warm, clocked-up cores; 0 disables pinning (default: 0)."
+    )
     ARGS = parser.parse_args() 
+    if ARGS.qsv_sessions < 1:
+        parser.error("--qsv-sessions must be at least 1")
+    NUM_FFMPEG_WORKERS = ARGS.qsv_sessions
+    if ARGS.ffmpeg_threads < 0:
+        parser.error("--ffmpeg-threads cannot be negative")
+    if ARGS.pin_cpus < 0:
+        parser.error("--pin-cpus cannot be negative")
+    # Left at 0, every FFmpeg would size its thread pools to the whole machine and the sessions would oversubscribe it
+    FFMPEG_SESSION_THREADS = ARGS.ffmpeg_threads or ARGS.pin_cpus or max(1, len(os.sched_getaffinity(0)) // NUM_FFMPEG_WORKERS)
+    build_ffmpeg_templates()
+
+    # A PATH lookup instead of running each tool with -version: no fork+exec before the UI starts
+    required_tools = [FFMPEG_PATH] + ([FFPROBE_PATH] if av is None else []) # With PyAV, ffprobe is only a fallback
+    missing_tools = [tool for tool in required_tools if shutil.which(tool) is None]
+    if missing_tools:
+        print(f"CRITICAL ERROR: Not found or not executable: {', '.join(missing_tools)}", file=sys.stderr)
+        print("Install FFmpeg or set FFMPEG_PATH/FFPROBE_PATH in the script's configuration.", file=sys.stderr)
+        sys.exit(1)
+    if av is not None and shutil.which(FFPROBE_PATH) is None:
+        print(f"Warning: '{FFPROBE_PATH}' not found; files PyAV cannot read will fail the codec check.", file=sys.stderr)
 
     try:
         os.makedirs(TEMP_DIRECTORY, exist_ok=True)